@@ -1,9 +1,13 @@
+import asyncio
+import concurrent.futures
 import contextlib
 import copy
+import functools
 import logging
 import MySQLdb
 import os
-from sqlalchemy import create_engine
+import threading
+from sqlalchemy import create_engine, event, exc
 from sqlalchemy.orm import sessionmaker, scoped_session
 import ujson as json
 
@@ -39,7 +43,23 @@ except Exception:
     mysql_prog_error = Exception
 
 
-def sqlalchemy_engine(perm='rw', convert_unicode=True, db=None):
+# Pool settings for engines handed out by get_engine
+POOL_OPTIONS = {
+    "pool_size": 5,
+    "max_overflow": 10,
+    "pool_pre_ping": True,  # Transparently replace connections dropped by the server
+    "pool_recycle": 3600,  # Stay below mysql wait_timeout
+}
+
+_engines = {}  # (db, perm) -> (pid, engine, session factory)
+_engines_lock = threading.Lock()
+_urls = {}  # (db, perm) -> (url, engine kwargs), see register_engine
+
+# Worker threads for the async dao methods, see run_sync
+_async_executor = None  # (pid, executor)
+
+
+def sqlalchemy_engine(perm='rw', convert_unicode=True, db=None, **kwargs):
     conn_param = infer_perm_route(perm)
     # mysql+mysqldb
     engine = create_engine(
@@ -50,10 +70,75 @@ def sqlalchemy_engine(perm='rw', convert_unicode=True, db=None):
             conn_param['port'],
             db if db else conn_param['db'],  # Allow for custom db
         ),
-        convert_unicode=convert_unicode)
+        convert_unicode=convert_unicode,
+        **kwargs)
     return engine
 
 
+def get_engine(db=None, perm='rw'):
+    """ 
+    Process-wide pooled engine for (db, perm). 
+    Forked children (e.g. ProcessPoolExecutor workers) get their own engine instead of
+    sharing the parent's sockets.
+    """
+    return _get_registry_entry(db, perm)[1]
+
+
+def register_engine(url, db=None, perm='rw', **kwargs):
+    """ 
+    Route (db, perm) to a custom database url, e.g. sqlite:///test.db as a stand-in for mysql in tests.
+    Applies to both dao layers, as long as it is called before db.orm.init
+    """
+    with _engines_lock:
+        _urls[(db, perm)] = (url, kwargs)
+        entry = _engines.pop((db, perm), None)
+    if entry is not None and entry[0] == os.getpid():
+        entry[1].dispose()
+    return get_engine(db=db, perm=perm)
+
+
+def dispose_engines():
+    """ Close all pooled connections, engines are recreated on next use """
+    with _engines_lock:
+        for pid, engine, _ in _engines.values():
+            if pid == os.getpid():
+                engine.dispose()
+        _engines.clear()
+
+
+def _get_registry_entry(db, perm):
+    key = (db, perm)
+    pid = os.getpid()
+    with _engines_lock:
+        entry = _engines.get(key)
+        if entry is None or entry[0] != pid:
+            if key in _urls:
+                url, kwargs = _urls[key]
+                engine = create_engine(url, **kwargs)
+            else:
+                engine = sqlalchemy_engine(perm=perm, db=db, **POOL_OPTIONS)
+            _add_fork_guard(engine)
+            entry = (pid, engine, sessionmaker(bind=engine))
+            _engines[key] = entry
+    return entry
+
+
+def _add_fork_guard(engine):
+    """ Invalidate pooled connections that were opened in a different process """
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        pid = os.getpid()
+        if connection_record.info['pid'] != pid:
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError(
+                f"Connection record belongs to pid {connection_record.info['pid']}, "
+                f"attempting to check out in pid {pid}")
+
+
 @contextlib.contextmanager
 def sqlalchemy_session(engine):
     factory = sessionmaker(bind=engine)
@@ -64,11 +149,33 @@ def sqlalchemy_session(engine):
 
 @contextlib.contextmanager
 def sqlalchemy_engine_session(db=None):
-    """this function is purely to save some typing. engine should be a singleton ideally, which can be done later"""
-    engine = sqlalchemy_engine(db=db)
-    with sqlalchemy_session(engine) as session:
+    """ Session on the pooled engine for db, the session is closed and its connection returned to the pool on exit """
+    factory = _get_registry_entry(db, 'rw')[2]
+    session = factory()
+    try:
         yield session
-    engine.dispose()
+    finally:
+        session.close()
+
+
+async def run_sync(func, *args, **kwargs):
+    """ 
+    Await a blocking database call without stalling the event loop. Calls run on a dedicated thread
+    pool sized to the connection pool, so that excess calls queue for a thread rather than a connection
+    """
+    global _async_executor
+    pid = os.getpid()
+    with _engines_lock:
+        if _async_executor is None or _async_executor[0] != pid:
+            _async_executor = (pid,
+                               concurrent.futures.ThreadPoolExecutor(
+                                   max_workers=POOL_OPTIONS["pool_size"] +
+                                   POOL_OPTIONS["max_overflow"],
+                                   thread_name_prefix="pf_manager_db"))
+        executor = _async_executor[1]
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        executor, functools.partial(func, *args, **kwargs))
 
 
 if __name__ == '__main__':
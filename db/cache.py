@@ -0,0 +1,119 @@
+"""
+In-process result cache for functional SQL reads (BaseDAOModel.get(cache=True)).
+Entries are keyed by table name and the normalized query arguments, evicted by LRU and TTL, and
+invalidated per table by the write methods of the dao classes once their transaction commits.
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import scoped_session
+
+
+class QueryCache:
+    """
+    maxsize: maximum number of cached results, least recently used entries are evicted first
+    ttl: seconds before an entry expires, regardless of writes
+    """
+    def __init__(self, maxsize: int = 256, ttl: float = 300.):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # (table, args) -> (expiry, value)
+        self._listeners = {}  # table -> callbacks fired on invalidation
+        self._lock = threading.RLock()
+        # session.info key of the tables to invalidate when the session commits
+        self._info_key = ("query_cache", id(self))
+
+    def get(self, key: tuple):
+        """ Returns (hit, value) """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+
+    def put(self, key: tuple, value) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, table: str = None) -> None:
+        """ Drop cached results of a table, or everything if table is None """
+        with self._lock:
+            if table is None:
+                self._entries.clear()
+            else:
+                for key in [x for x in self._entries if x[0] == table]:
+                    del self._entries[key]
+            listeners = [
+                cb for tbl, cbs in self._listeners.items()
+                if table is None or tbl == table for cb in cbs
+            ]
+        for callback in listeners:
+            callback()
+
+    def invalidate_on_commit(self, session, table: str) -> None:
+        """
+        Invalidate table once the current transaction of session commits, so that a read in between
+        can't cache rows that are not committed yet. Nothing is invalidated if the transaction rolls back
+        """
+        if isinstance(session, scoped_session):
+            session = session()
+        pending = session.info.get(self._info_key)
+        if pending is None:
+            pending = session.info[self._info_key] = set()
+            event.listen(session, "after_commit", self._invalidate_pending)
+            event.listen(session, "after_rollback", self._discard_pending)
+        pending.add(table)
+
+    def _invalidate_pending(self, session) -> None:
+        pending = session.info[self._info_key]
+        while pending:
+            self.invalidate(pending.pop())
+
+    def _discard_pending(self, session) -> None:
+        session.info[self._info_key].clear()
+
+    def subscribe(self, table: str, callback) -> None:
+        """ Call callback whenever table is invalidated, e.g. to refresh an in-memory index """
+        with self._lock:
+            self._listeners.setdefault(table, []).append(callback)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries)
+            }
+
+    def clear_stats(self) -> None:
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+
+def normalize(obj):
+    """ Hashable, order preserving representation of functional SQL arguments """
+    if isinstance(obj, dict):
+        return tuple((k, normalize(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return tuple(normalize(x) for x in obj)
+    if isinstance(obj, (set, frozenset)):
+        return tuple(sorted(normalize(x) for x in obj))
+    return obj
+
+
+# Process-wide cache shared by all dao classes
+query_cache = QueryCache()
@@ -1,18 +1,34 @@
-from sqlalchemy import distinct
+import csv
+import numpy as np
+import os
+import pandas as pd
+import tempfile
+from sqlalchemy import and_, distinct, func, text
+from sqlalchemy import types as sqltypes
 
-from pf_manager.db import entity
+from pf_manager.db import entity, run_sync, sqlalchemy_engine_session
+from pf_manager.db.cache import query_cache
+from pf_manager.db.utils import _df_to_columns, query_to_df, read_csv_chunks
 
 
 class BaseDao(object):
+    """ 
+    Write methods invalidate cached functional SQL results of the table once the session commits,
+    see db.cache.
+    The async write methods (prefixed with a) run in their own committed session on a db worker
+    thread, so they can be awaited from the event loop
+    """
     def __init__(self, Entity):
         self.Entity = Entity
 
     def add(self, session, entry):
         session.add(entry)
+        self.invalidate_cache(session)
 
     def add_all(self, session, entries: list):
         # Always use add_by_date since it prevents duplicates, only use this if bulk uploading
         session.add_all(entries)
+        self.invalidate_cache(session)
 
     def add_by_date(self, session, entries: list):
         entry_dt = {x.date for x in entries}
@@ -25,6 +41,178 @@ class BaseDao(object):
             self.delete_by_date(session, filedate)
             self.add_all(session, entries)
 
+    def bulk_insert(self,
+                    session,
+                    data,
+                    chunksize: int = 10000,
+                    infile: bool = False) -> int:
+        """
+        Insert a DataFrame or dict of column arrays without building ORM objects, returns the row count.
+        Rows are written with a chunked executemany, which mysqlclient sends as multi-row INSERTs.
+        infile: use LOAD DATA LOCAL INFILE on mysql, the connection needs local_infile=1 (connect_args)
+                and the server needs local_infile enabled. Ignored on other databases.
+        """
+        columns = _df_to_columns(data, self.Entity)
+        n = len(next(iter(columns.values()))) if columns else 0
+        if n == 0:
+            return 0
+
+        if infile and session.bind.dialect.name == "mysql":
+            self._load_infile(session, columns)
+        else:
+            table = self.Entity.__table__
+            names = list(columns)
+            values = list(columns.values())
+            # Build the row dicts per chunk, so that only one chunk of them is held at a time
+            for i in range(0, n, chunksize):
+                rows = [
+                    dict(zip(names, x))
+                    for x in zip(*[v[i:i + chunksize] for v in values])
+                ]
+                session.execute(table.insert(), rows)
+        self.invalidate_cache(session)
+        return n
+
+    def bulk_insert_csv(self,
+                        session,
+                        path: str,
+                        chunksize: int = 50000,
+                        date_format: str = None,
+                        **kwargs) -> int:
+        """ Stream a csv into the table chunk by chunk with bulk_insert, see db.utils.read_csv_chunks """
+        n = 0
+        for chunk in read_csv_chunks(path,
+                                     self.Entity,
+                                     chunksize=chunksize,
+                                     date_format=date_format,
+                                     **kwargs):
+            n += self.bulk_insert(session, chunk)
+        return n
+
+    def bulk_insert_by_date(self, session, data, **kwargs) -> int:
+        """ add_by_date counterpart of bulk_insert, data must hold a single date """
+        dates = set(_df_to_columns({"date": data["date"]}, self.Entity)["date"])
+        if len(dates) != 1:
+            raise Exception(
+                "There should only be one file date present in the list of records"
+            )
+        self.delete_by_date(session, dates.pop())
+        return self.bulk_insert(session, data, **kwargs)
+
+    def merge_by_date(self, session, data, key: list = None) -> dict:
+        """
+        Diff based alternative to add_by_date, only rows that differ are written.
+        Existing rows of the date are matched to data on the natural key columns, repeated keys are
+        matched in order. Matched rows with changed values are updated in place, unmatched existing
+        rows are deleted and unmatched new rows are inserted. Numeric columns are compared with np.isclose.
+        key: natural key columns, defaults to the KEYS of the dao
+        Returns the number of inserted, updated, deleted and unchanged rows.
+        """
+        key = list(key or getattr(self, "KEYS", None) or [])
+        if not key:
+            raise ValueError(
+                f"A natural key is required to merge into {self.Entity.__tablename__}")
+        new = pd.DataFrame(_df_to_columns(data, self.Entity))
+        dates = set(new["date"])
+        if len(dates) != 1:
+            raise Exception(
+                "There should only be one file date present in the list of records"
+            )
+        dt = dates.pop()
+        key = key if "date" in key else key + ["date"]
+        compare = [x for x in new.columns if x not in key + ["id"]]
+
+        query_obj, Entity = self.mget_by_dates_custom(session, dt, dt)
+        old = query_to_df(query_obj).sort_values("id")[["id"] + key + compare]
+        for df in [old, new]:
+            df["_n"] = df.groupby(key, dropna=False, sort=False).cumcount()
+        merged = old.merge(new.drop(columns="id", errors="ignore"),
+                           on=key + ["_n"],
+                           how="outer",
+                           suffixes=("_old", ""),
+                           indicator=True)
+
+        both = merged[merged["_merge"] == "both"]
+        changed = np.zeros(len(both), dtype=bool)
+        types = {c.name: c.type for c in Entity.__table__.columns}
+        for col in compare:
+            a, b = both[f"{col}_old"], both[col]
+            if isinstance(types[col], (sqltypes.Numeric, sqltypes.Integer)):
+                a, b = a.astype("float64").values, b.astype("float64").values
+                changed |= ~np.isclose(a, b, equal_nan=True)
+            else:
+                changed |= ((a != b) & ~(a.isna() & b.isna())).values
+        updates = both[changed]
+        deletes = merged.loc[merged["_merge"] == "left_only", "id"]
+        inserts = merged.loc[merged["_merge"] == "right_only", key + compare]
+
+        if len(deletes):
+            session.query(Entity).filter(Entity.id.in_(
+                deletes.astype(int).tolist())).delete(synchronize_session=False)
+        if len(updates):
+            rows = _df_to_columns(updates[compare], Entity)
+            rows["id"] = updates["id"].astype(int).tolist()
+            session.bulk_update_mappings(
+                Entity, [dict(zip(rows, x)) for x in zip(*rows.values())])
+        if len(inserts):
+            self.bulk_insert(session, inserts)
+        if len(deletes) or len(updates):
+            self.invalidate_cache(session)
+        return {
+            "inserted": len(inserts),
+            "updated": len(updates),
+            "deleted": len(deletes),
+            "unchanged": len(both) - len(updates)
+        }
+
+    def invalidate_cache(self, session=None):
+        """ Invalidate once the transaction of session commits, or right away without a session """
+        if session is None:
+            query_cache.invalidate(self.Entity.__tablename__)
+        else:
+            query_cache.invalidate_on_commit(session, self.Entity.__tablename__)
+
+    async def aadd(self, entry, db=None):
+        await run_sync(self._commit, self.add, entry, db=db)
+
+    async def aadd_all(self, entries: list, db=None):
+        await run_sync(self._commit, self.add_all, entries, db=db)
+
+    async def aadd_by_date(self, entries: list, db=None):
+        await run_sync(self._commit, self.add_by_date, entries, db=db)
+
+    async def adelete_by_date(self, dt, db=None):
+        await run_sync(self._commit, self.delete_by_date, dt, db=db)
+
+    async def adelete_all(self, db=None):
+        await run_sync(self._commit, self.delete_all, db=db)
+
+    def _load_infile(self, session, columns: dict) -> None:
+        fd, path = tempfile.mkstemp(suffix=".csv")
+        try:
+            with os.fdopen(fd, "w", newline="") as f:
+                writer = csv.writer(f, lineterminator="\n")
+                # Without an escape character an unquoted NULL is read as null,
+                # booleans are loaded into TINYINT columns
+                writer.writerows([
+                    "NULL" if v is None else int(v) if isinstance(v, bool) else v
+                    for v in row
+                ] for row in zip(*columns.values()))
+            cols = ", ".join(f"`{x}`" for x in columns)
+            session.execute(
+                text(f"LOAD DATA LOCAL INFILE :path "
+                     f"INTO TABLE `{self.Entity.__tablename__}` "
+                     f"FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' "
+                     f"ESCAPED BY '' LINES TERMINATED BY '\\n' ({cols})"),
+                {"path": path})
+        finally:
+            os.remove(path)
+
+    def _commit(self, method, *args, db=None):
+        with sqlalchemy_engine_session(db) as session:
+            method(session, *args)
+            session.commit()
+
     def mget_all(self, session):
         return self.mget_all_custom(session)[0].all()
 
@@ -50,9 +238,11 @@ class BaseDao(object):
             self.Entity.date.between(
                 dt.strftime('%Y-%m-%d'),
                 dt.strftime('%Y-%m-%d'))).delete(synchronize_session=False)
+        self.invalidate_cache(session)
 
     def delete_all(self, session):
         session.query(self.Entity).delete(synchronize_session=False)
+        self.invalidate_cache(session)
 
 
 class Blotter(BaseDao):
@@ -97,4 +287,72 @@ class Dividends(BaseDao):
 
 def get_Dividends_dao():
     """Don't create DAO object but use `get_xxx_dao()`, since DAO object should be singleton"""
-    return Dividends(entity.Dividends)
\ No newline at end of file
+    return Dividends(entity.Dividends)
+
+
+class PositionSnapshots(BaseDao):
+    """ 
+    Sparse end of day positions, one row per (strategy, portfolio, book, name) per trade date.
+    blotter_id is the highest blotter id reflected when the row was written.
+    A single row without a date or key records the highest blotter id processed, which moves on even
+    when no snapshot changes, e.g. when all new blotter rows are not executed.
+    """
+    KEYS = ["strategy", "portfolio", "book", "name"]
+
+    def mget_watermark(self, session) -> int:
+        return session.query(func.max(self.Entity.blotter_id)).scalar() or 0
+
+    def upsert_watermark(self, session, blotter_id: int):
+        session.query(self.Entity).filter(self.Entity.date.is_(None)).delete(
+            synchronize_session=False)
+        session.add(self.Entity(blotter_id=blotter_id))
+        self.invalidate_cache(session)
+
+    def mget_latest_custom(self, session, dt):
+        """ Latest snapshot on or before dt for every key, to chain further methods on """
+        Entity = self.Entity
+        cols = [getattr(Entity, x) for x in self.KEYS]
+        latest = session.query(*cols, func.max(Entity.date).label("date")).filter(
+            Entity.date <= dt.strftime('%Y-%m-%d')).group_by(*cols).subquery()
+        return (session.query(Entity).join(
+            latest,
+            and_(Entity.date == latest.c.date,
+                 *[getattr(Entity, x) == latest.c[x] for x in self.KEYS])), Entity)
+
+
+def get_PositionSnapshots_dao():
+    """Don't create DAO object but use `get_xxx_dao()`, since DAO object should be singleton"""
+    return PositionSnapshots(entity.PositionSnapshots)
+
+
+class DumpManifest(BaseDao):
+    """ Fingerprint (content hash, row count, mtime) of the source of every date dumped into a table, see utilfns.dump """
+    def mget_by_table(self, session, table_name: str) -> dict:
+        """ date -> manifest entry """
+        return {
+            x.date: x
+            for x in session.query(self.Entity).filter(
+                self.Entity.table_name == table_name)
+        }
+
+    def upsert(self, session, table_name: str, dt, **fields):
+        entry = session.query(self.Entity).filter(
+            self.Entity.table_name == table_name,
+            self.Entity.date == dt).first()
+        if entry is None:
+            entry = self.Entity(table_name=table_name, date=dt)
+            session.add(entry)
+        for k, v in fields.items():
+            setattr(entry, k, v)
+        self.invalidate_cache(session)
+
+    def delete_by_table(self, session, table_name: str):
+        session.query(self.Entity).filter(
+            self.Entity.table_name == table_name).delete(
+                synchronize_session=False)
+        self.invalidate_cache(session)
+
+
+def get_DumpManifest_dao():
+    """Don't create DAO object but use `get_xxx_dao()`, since DAO object should be singleton"""
+    return DumpManifest(entity.DumpManifest)
@@ -0,0 +1,86 @@
+"""
+Schema driven dtype materialization for DataFrames read from the database.
+DECIMAL columns come back from mysql as python Decimal objects (object dtype), which pushes pandas
+arithmetic into python loops. materialize converts them to float64, or to scaled int64 fixed point
+when exactness matters, and converts low cardinality string columns to categoricals.
+"""
+
+import numpy as np
+import pandas as pd
+from pandas.core.frame import DataFrame
+from sqlalchemy import types as sqltypes
+
+# Low cardinality string columns that are worth storing as categoricals
+CATEGORICAL_COLUMNS = ["name", "strategy", "portfolio", "book", "account"]
+
+
+def entity_types(Entity) -> dict:
+    """ Column name to sqlalchemy type mapping of an ORM entity """
+    return {c.name: c.type for c in Entity.__table__.columns}
+
+
+def csv_dtypes(Entity) -> tuple:
+    """
+    pandas dtypes to read a csv of an ORM entity with, and the date columns of the entity.
+    Integers and booleans use the nullable pandas dtypes, DECIMAL is read as float64 and dates are
+    read as strings to be parsed in one vectorized pass, see db.utils.read_csv_chunks
+    """
+    dtypes, dates = {}, []
+    for col, coltype in entity_types(Entity).items():
+        if isinstance(coltype, (sqltypes.Date, sqltypes.DateTime)):
+            dtypes[col] = "object"
+            dates.append(col)
+        elif isinstance(coltype, sqltypes.Boolean):
+            dtypes[col] = "boolean"
+        elif isinstance(coltype, sqltypes.Integer):
+            dtypes[col] = "Int64"
+        elif isinstance(coltype, sqltypes.Numeric):
+            dtypes[col] = "float64"
+        elif isinstance(coltype, sqltypes.String):
+            dtypes[col] = "object"
+    return dtypes, dates
+
+
+def materialize(df: DataFrame,
+                types: dict,
+                decimal: str = "float",
+                categorical: list = CATEGORICAL_COLUMNS) -> DataFrame:
+    """
+    Convert columns of df in place based on their sqlalchemy types, and return df.
+    types: column name to sqlalchemy type, e.g. entity_types(Entity). Columns without a type are left as is
+    decimal: "float" -> float64, "fixed" -> nullable Int64 scaled by 10 ** scale, None -> leave as Decimal
+    categorical: string columns to convert to category dtype
+    """
+    if df.empty:
+        return df
+
+    for col, coltype in types.items():
+        if col not in df:
+            continue
+        if isinstance(coltype, sqltypes.Numeric) and not isinstance(
+                coltype, sqltypes.Float) and decimal:
+            df[col] = _decimal_to_numeric(df[col], coltype.scale, decimal)
+        elif isinstance(coltype, sqltypes.String) and col in categorical:
+            df[col] = df[col].astype("category")
+    return df
+
+
+def from_fixed(values: pd.Series, scale: int) -> pd.Series:
+    """ Convert a scaled int64 fixed point column back to float64 """
+    return values.astype("float64") / 10**scale
+
+
+def _decimal_to_numeric(values: pd.Series, scale: int,
+                        decimal: str) -> pd.Series:
+    if decimal == "float":
+        # None maps to NaN, Decimal is converted through float()
+        return pd.Series(np.array(values.tolist(), dtype="float64"),
+                         index=values.index)
+    elif decimal == "fixed":
+        # Exact conversion, note that int64 caps the magnitude at ~9.2e18 / 10 ** scale
+        scale = scale or 0
+        return pd.Series(pd.array(
+            [None if pd.isna(x) else int(round(x * 10**scale)) for x in values],
+            dtype="Int64"),
+                         index=values.index)
+    raise ValueError(f"{decimal} is not a supported decimal conversion")
@@ -74,3 +74,26 @@ class Dividends(Base):
     qty = Column(DECIMAL(40, 8))
     dps = Column(DECIMAL(40, 8))
     amount = Column(DECIMAL(40, 8))
+
+
+class PositionSnapshots(Base):
+    __tablename__ = 'position_snapshots'
+    id = Column(Integer, primary_key=True)
+    date = Column(Date, index=True)
+    strategy = Column(String(80), index=True)
+    portfolio = Column(String(80), index=True)
+    book = Column(String(80), index=True)
+    name = Column(String(80), index=True)
+    qty = Column(BIGINT)
+    blotter_id = Column(Integer, index=True)
+
+
+class DumpManifest(Base):
+    __tablename__ = 'dump_manifest'
+    id = Column(Integer, primary_key=True)
+    table_name = Column(String(80), index=True)
+    date = Column(Date, index=True)
+    hash = Column(String(64))
+    row_count = Column(BIGINT)
+    mtime = Column(DateTime)
+    dumped_at = Column(DateTime)
@@ -1,20 +1,35 @@
 import contextlib
+import contextvars
+import itertools
 import logging
 import os
 import pandas as pd
 import sqlalchemy
-from typing import Union
-import ujson
+import threading
+from typing import Iterator, Union
 
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy import bindparam
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import sessionmaker
+
+from pf_manager.db import get_engine, run_sync
+from pf_manager.db.cache import normalize, query_cache
+from pf_manager.db.dtypes import materialize
+from pf_manager.db.utils import entity_to_df, entity_to_dict, _resultproxy_to_df, _rows_to_df
 
 LOGGER = logging.getLogger(__name__)
 
 _engine = None
 _factory = None
+_init_lock = threading.Lock()
+
+# Session of the enclosing transaction, if any. Context variables are local to each thread and to
+# each asyncio task, so concurrent workers never share a session
+_ss = contextvars.ContextVar("pf_manager_orm_session", default=None)
 
-# TODO: _session should be thread local.
-_ss = None
+# Baked (pre-built and pre-compiled) queries and their column descriptions, keyed by query shape
+_bakery = baked.bakery(size=500)
+_shape_descriptions = {}
 
 
 def get_creds_file():
@@ -22,97 +37,69 @@ def get_creds_file():
         os.path.join(os.path.dirname(__file__), "../..", 'creds.json'))
 
 
-def init(db: str = None):
+def init(db: str = None, url: str = None):
+    """ url connects to a custom database instead, e.g. sqlite:// for tests and benchmarks """
     global _engine, _factory
-    if _engine is None:
-        with open(get_creds_file(), 'r') as f:
-            param = ujson.load(f)['conn_param_admin']
-        _engine = sqlalchemy.create_engine(
-            f'mysql://{param["user"]}:{param["passwd"]}@{param["host"]}:{param["port"]}/{db if db else param["db"]}'
-        )
-    if _factory is None:
-        _factory = sessionmaker(bind=_engine)
+    if _factory is not None:
+        return
+    with _init_lock:
+        if _engine is None:
+            # Share the process-wide pooled engine with the dao layer
+            _engine = sqlalchemy.create_engine(url) if url else get_engine(
+                db=db)
+        if _factory is None:
+            _factory = sessionmaker(bind=_engine)
 
 
 def destroy():
-    global _engine
-    if _engine is not None:
-        _engine.dispose()
+    global _engine, _factory
+    with _init_lock:
+        if _engine is not None:
+            _engine.dispose()
+        _engine = None
+        _factory = None
 
 
 @contextlib.contextmanager
 def _session(auto_commit=True):
-    global _ss
-    if _ss is not None:
-        yield _ss
+    current = _ss.get()
+    if current is not None:
+        yield current
         # don't commit here in case there is a transaction going on.
         return
 
     init()
-    ss = scoped_session(_factory)
-    yield ss
-    if auto_commit:
+    # A new session per call, sessions are not thread safe and must not be shared between workers
+    ss = _factory()
+    try:
+        yield ss
+        if auto_commit:
+            try:
+                ss.commit()
+            except Exception:
+                LOGGER.exception('failed to commit')
+    finally:
+        # Also reached when a streaming generator is closed early
         try:
-            ss.commit()
+            ss.close()
         except Exception:
-            LOGGER.exception('failed to commit')
-    try:
-        ss.close()
-    except Exception:
-        LOGGER.exception('failed to close sqlalchemy session')
+            LOGGER.exception('failed to close sqlalchemy session')
 
 
 @contextlib.contextmanager
 def transaction(func, *args, auto_commit=True):
-    global _ss
-    if _ss is not None:
+    if _ss.get() is not None:
         func(*args)
         return
 
     with _session(auto_commit=auto_commit) as ss:
-        _ss = ss
+        token = _ss.set(ss)
         try:
             func(*args)
         except Exception:
             raise
         finally:
-            _ss = None
-
-
-def entity_to_df(rows):
-    """
-    convert a list of entity object to DataFrame
-    TODO(x) to be backward compatible, DataFrame should always have columns even if it's empty.
-    """
-    d = {}
-    n = 0
-    if rows is not None:
-        for row in rows:
-            d[n] = entity_to_dict(row)
-            n += 1
-    return pd.DataFrame.from_dict(d, orient='index')
-
-
-def _resultproxy_to_df(rp):
-    """
-    1. session.execute() returns a ResultProxy
-    2. ResultProxy if it doesn't query ORM class.
-    For ease of use, let's convert ResultProxy to DataFrame before returning.
-    """
-    d = {}
-    n = 0
-    if rp is not None:
-        for row in rp:
-            d[n] = dict(zip(row.keys(), row))
-            n += 1
-    return pd.DataFrame.from_dict(d, orient='index')
-
-
-def entity_to_dict(r):
-    d = {}
-    for column in r.__table__.columns:
-        d[column.name] = getattr(r, column.name)
-    return d
+            _ss.reset(token)
 
 
 class BaseDAOModel():
@@ -120,6 +107,8 @@ class BaseDAOModel():
     Ensure that children sets the relevant ORM Entity as a class attribute.
     """
     Entity = None
+    # Cache query construction and compilation per query shape, see _baked_query
+    use_baked_queries = True
 
     @classmethod
     def isValidIter(cls, item):
@@ -131,7 +120,9 @@ class BaseDAOModel():
             by: Union[list, tuple, dict] = None,
             where: list = None,
             cols: Union[list, tuple, dict] = None,
-            df_flag: bool = True) -> Union[pd.DataFrame, list]:
+            df_flag: bool = True,
+            typed: bool = False,
+            cache: bool = False) -> Union[pd.DataFrame, list]:
         """ Functional SQL - SQL as a function
         DAO.get(): Extract all data from a table. Use with care
         DAO.get(cols=["asset", "trading_day", "pnl"]): Select asset, trading_day and pnl table 
@@ -142,6 +133,8 @@ class BaseDAOModel():
         DAO.get(cols={"pnl":"sum", "pnl_mean":("mean","pnl")}): Select all pnl records and rename it pnl_mean
         DAO.get(cols={"asset":"distinct"}): Select all distinct asset
         DAO.get(df_flag=False): Return in ORM classes instead of pandas dataframe
+        DAO.get(typed=True): DECIMAL columns as float64 and low cardinality strings as categoricals
+        DAO.get(cache=True): Serve repeated DataFrame queries from the in-process cache, see db.cache
         All list or tuple parameters are interchangable in this method.
         User can mix the group by, where and select clauses in various combinations, e.g.
         ***
@@ -157,97 +150,259 @@ class BaseDAOModel():
         })
         ***
         """
+        # Only DataFrames are cached, ORM entities are bound to their session
+        key = None
+        if cache and df_flag:
+            key = cls._cache_key(by, where, cols, typed)
+            hit, df = query_cache.get(key)
+            if hit:
+                return df.copy()
+
+        params = cls._where_params(where)
+        # Read only, so no commit, which would also expire the returned ORM entities. Rows are
+        # fetched before the session closes so that its connection goes back to the pool in this thread
+        with _session(auto_commit=False) as ss:
+            if cls.use_baked_queries:
+                query_obj, descriptions = cls._baked_query(
+                    ss, by, where, cols, df_flag)
+            else:
+                query_obj = cls._build_query(ss,
+                                             by=by,
+                                             where=where,
+                                             cols=cols,
+                                             df_flag=df_flag)
+                descriptions = query_obj.column_descriptions
+            res = query_obj.params(**params).all()
+
+        if df_flag:
+            df = _rows_to_df(res, [x["name"] for x in descriptions])
+            if typed:
+                materialize(df, {x["name"]: x["type"] for x in descriptions})
+            if key:
+                query_cache.put(key, df.copy())
+            return df
+        return res
+
+    @classmethod
+    async def aget(cls,
+                   by: Union[list, tuple, dict] = None,
+                   where: list = None,
+                   cols: Union[list, tuple, dict] = None,
+                   df_flag: bool = True,
+                   typed: bool = False,
+                   cache: bool = False) -> Union[pd.DataFrame, list]:
+        """ Awaitable get, runs on a db worker thread so that the event loop is not blocked """
+        return await run_sync(cls.get,
+                              by=by,
+                              where=where,
+                              cols=cols,
+                              df_flag=df_flag,
+                              typed=typed,
+                              cache=cache)
+
+    @classmethod
+    def invalidate_cache(cls, session=None) -> None:
+        """
+        Drop cached results for this table, DAO write methods should call this with their session
+        so that it happens once the session commits, see QueryCache.invalidate_on_commit
+        """
+        if session is None:
+            query_cache.invalidate(cls.Entity.__tablename__)
+        else:
+            query_cache.invalidate_on_commit(session, cls.Entity.__tablename__)
+
+    @classmethod
+    def _cache_key(cls, by, where, cols, typed) -> tuple:
+        if where and len(where) <= 3 and not cls.isValidIter(where[0]):
+            where = [where]
+        return (cls.Entity.__tablename__, normalize(by), normalize(where),
+                normalize(cols), typed)
+
+    @classmethod
+    def stream(cls,
+               by: Union[list, tuple, dict] = None,
+               where: list = None,
+               cols: Union[list, tuple, dict] = None,
+               chunksize: int = 10000,
+               df_flag: bool = True,
+               typed: bool = False) -> Iterator[Union[pd.DataFrame, list]]:
+        """ 
+        Same arguments as get, but rows are read through a server side cursor and yielded in chunks of
+        chunksize rows, so memory stays bounded regardless of table size.
+        Yields DataFrames, or lists of raw row tuples if df_flag is False.
+        DAO.stream(where=[("date", (sdt, edt), "between")], chunksize=50000)
+        Note that with typed=True categories are inferred per chunk.
+        """
+        with _session(auto_commit=False) as ss:
+            query_obj = cls._build_query(ss,
+                                         by=by,
+                                         where=where,
+                                         cols=cols,
+                                         df_flag=True)
+            descriptions = query_obj.column_descriptions
+            columns = [x["name"] for x in descriptions]
+            rows = iter(
+                query_obj.params(**cls._where_params(where)).execution_options(
+                    stream_results=True).yield_per(chunksize))
+            while True:
+                chunk = list(itertools.islice(rows, chunksize))
+                if not chunk:
+                    break
+                if not df_flag:
+                    yield chunk
+                    continue
+                df = _rows_to_df(chunk, columns)
+                if typed:
+                    materialize(df,
+                                {x["name"]: x["type"]
+                                 for x in descriptions})
+                yield df
+
+    @classmethod
+    def _baked_query(cls, ss, by, where, cols, df_flag):
+        """ 
+        Query construction and SQL compilation happen once per query shape, i.e. the arguments
+        with the where clause values stripped out. Returns the baked query and its column descriptions.
+        """
+        shape = (normalize(by), cls._where_shape(where), normalize(cols),
+                 df_flag)
+        descriptions = _shape_descriptions.get((cls, shape))
+        if descriptions is None:
+            query_obj = cls._build_query(ss, by, where, cols, df_flag)
+            descriptions = [{
+                "name": x["name"],
+                "type": x["type"]
+            } for x in query_obj.column_descriptions]
+            _shape_descriptions[(cls, shape)] = descriptions
+
+        # The lambda is only invoked on a cache miss, i.e. with arguments of the same shape
+        bq = _bakery(lambda s: cls._build_query(s, by, where, cols, df_flag),
+                     cls, shape)
+        return bq(ss), descriptions
+
+    @classmethod
+    def _where_clauses(cls, where: list) -> list:
+        """ Normalize the where argument into (field, op, value) clauses, op is one of eq, is_null, in, ge, le """
+        valid_where_ops = ["in", "between"]
+        clauses = []
+        if not where:
+            return clauses
+        if len(where) <= 3 and not (cls.isValidIter(where[0])):
+            where = [where]
+        for wc in where:
+            # Defaults to equals
+            field = wc[0]
+            params = wc[1]
+            if len(wc) == 2:
+                clauses.append(
+                    (field, "is_null" if params is None else "eq", params))
+            elif len(wc) == 3:
+                op = wc[2]
+                assert op in valid_where_ops
+                if op == "in":
+                    clauses.append((field, "in", list(params)))
+                elif op == "between":
+                    # Support open ended between conditions via None being passed as param
+                    if params[0]:
+                        clauses.append((field, "ge", params[0]))
+                    if params[1]:
+                        clauses.append((field, "le", params[1]))
+                else:
+                    raise Exception(f"{op} operation is not supported yet")
+            else:
+                raise Exception(f"{wc} is an invalid where clause.")
+        return clauses
+
+    @classmethod
+    def _where_shape(cls, where: list) -> tuple:
+        return tuple((field, op) for field, op, _ in cls._where_clauses(where))
+
+    @classmethod
+    def _where_params(cls, where: list) -> dict:
+        return {
+            f"w{i}": value
+            for i, (_, op, value) in enumerate(cls._where_clauses(where))
+            if op != "is_null"
+        }
+
+    @classmethod
+    def _build_query(cls,
+                     ss,
+                     by: Union[list, tuple, dict] = None,
+                     where: list = None,
+                     cols: Union[list, tuple, dict] = None,
+                     df_flag: bool = True):
+        """ Builds the query for get and stream, see get for the arguments """
         func = sqlalchemy.func
         isValidIter = cls.isValidIter
-        valid_where_ops = ["in", "between"]
         valid_ops_mysql = [
             "sum", "distinct", "min", "max", "day", "month", "year", "avg"
         ]
         valid_ops_brahman = valid_ops_mysql + ["mean"]
 
-        with _session() as ss:
-            query_obj = None
-            entity_flag = False
-
-            # Selections
-            if isValidIter(cols):
-                query_obj = ss.query(*[getattr(cls.Entity, x) for x in cols])
-            elif isinstance(cols, dict):
-                select_cols = []
-                for field, args in cols.items():
+        query_obj = None
+
+        # Selections
+        if isValidIter(cols):
+            query_obj = ss.query(*[getattr(cls.Entity, x) for x in cols])
+        elif isinstance(cols, dict):
+            select_cols = []
+            for field, args in cols.items():
+                rename_col = field
+                op = cols[field]
+                if isValidIter(args):
+                    # Either aggregation required or rename of columns
                     rename_col = field
-                    op = cols[field]
-                    if isValidIter(args):
-                        # Either aggregation required or rename of columns
-                        rename_col = field
-                        field = op[1]
-                        op = op[0]
-                    column = getattr(cls.Entity, field)
-
-                    if op and op.lower() in valid_ops_mysql:
-                        select_cols.append(
-                            getattr(func, op)(column).label(rename_col))
-                    elif op == "mean":
-                        select_cols.append(func.avg(column).label(rename_col))
-                    elif not op:
-                        select_cols.append(column)
-                    else:
-                        raise Exception(
-                            f"{cols[field]} operation not supported yet")
-                query_obj = ss.query(*select_cols)
-            else:
-                query_obj = ss.query(cls.Entity)
-                entity_flag = True
-
-            # Filters - where clause
-            if where and query_obj:
-                if len(where) <= 3 and not (isValidIter(where[0])):
-                    where = [where]
-                for wc in where:
-                    # Defaults to equals
-                    field = wc[0]
-                    params = wc[1]
-                    column = getattr(cls.Entity, field)
-                    if len(wc) == 2:
-                        query_obj = query_obj.filter(column == params)
-                    elif len(wc) == 3:
-                        op = wc[2]
-                        assert op in valid_where_ops
-                        if op == "in":
-                            query_obj = query_obj.filter(column.in_(params))
-                        elif op == "between":
-                            # Support open ended between conditions via None being passed as param
-                            if params[0]:
-                                query_obj = query_obj.filter(
-                                    column >= params[0])
-                            if params[1]:
-                                query_obj = query_obj.filter(
-                                    column <= params[1])
-                        else:
-                            raise Exception(
-                                f"{op} operation is not supported yet")
-                    else:
-                        raise Exception(f"{wc} is an invalid where clause.")
-
-            # Group by
-            if by and query_obj:
-                if isValidIter(by):
-                    query_obj = query_obj.group_by(
-                        *[getattr(cls.Entity, x) for x in by])
+                    field = op[1]
+                    op = op[0]
+                column = getattr(cls.Entity, field)
+
+                if op and op.lower() in valid_ops_mysql:
+                    select_cols.append(
+                        getattr(func, op)(column).label(rename_col))
+                elif op == "mean":
+                    select_cols.append(func.avg(column).label(rename_col))
+                elif not op:
+                    select_cols.append(column)
                 else:
-                    if isinstance(by, dict):
-                        bys = []
-                        for col in by:
-                            op = by[col]
-                            assert op in valid_ops_brahman
-                            bys.append(
-                                getattr(func, op)(getattr(cls.Entity, col)))
-                        query_obj = query_obj.group_by(*bys)
-
-        res = query_obj.all()
-        if df_flag:
-            if entity_flag:
-                return entity_to_df(res)
+                    raise Exception(
+                        f"{cols[field]} operation not supported yet")
+            query_obj = ss.query(*select_cols)
+        elif df_flag:
+            # Select the raw columns rather than hydrating ORM entities for DataFrames
+            query_obj = ss.query(*cls.Entity.__table__.columns)
+        else:
+            query_obj = ss.query(cls.Entity)
+
+        # Filters - where clause, values are bound parameters so that the query shape can be cached
+        for i, (field, op, _) in enumerate(cls._where_clauses(where)):
+            column = getattr(cls.Entity, field)
+            param = f"w{i}"
+            if op == "eq":
+                query_obj = query_obj.filter(column == bindparam(param))
+            elif op == "is_null":
+                query_obj = query_obj.filter(column.is_(None))
+            elif op == "in":
+                query_obj = query_obj.filter(
+                    column.in_(bindparam(param, expanding=True)))
+            elif op == "ge":
+                query_obj = query_obj.filter(column >= bindparam(param))
+            elif op == "le":
+                query_obj = query_obj.filter(column <= bindparam(param))
+
+        # Group by
+        if by and query_obj:
+            if isValidIter(by):
+                query_obj = query_obj.group_by(
+                    *[getattr(cls.Entity, x) for x in by])
             else:
-                return _resultproxy_to_df(res)
-        return res
\ No newline at end of file
+                if isinstance(by, dict):
+                    bys = []
+                    for col in by:
+                        op = by[col]
+                        assert op in valid_ops_brahman
+                        bys.append(
+                            getattr(func, op)(getattr(cls.Entity, col)))
+                    query_obj = query_obj.group_by(*bys)
+
+        return query_obj
@@ -0,0 +1,31 @@
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import Column, Integer, String, Date, BIGINT, DECIMAL
+
+from pf_manager.db.orm import BaseDAOModel
+
+
+class Entity(declarative_base()):
+    __tablename__ = 'blotter'
+
+    id = Column(Integer, primary_key=True)
+    date = Column(Date, index=True)
+    account = Column(String(80))
+    name = Column(String(80), index=True)
+    strategy = Column(String(80), index=True)
+    price = Column(DECIMAL(40, 8))
+    qty = Column(BIGINT)
+    price_qty = Column(DECIMAL(40, 8))
+    action = Column(String(80))
+    execution_status = Column(String(80))
+    fees = Column(DECIMAL(40, 8))
+    amount = Column(DECIMAL(40, 8))
+    portfolio = Column(String(80), index=True)
+    book = Column(String(80), index=True)
+
+
+class DAO(BaseDAOModel):
+    Entity = Entity
+
+
+if __name__ == "__main__":
+    print(DAO.get(by=["name"], cols={"name": None, "qty": "sum"}))
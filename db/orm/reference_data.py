@@ -1,6 +1,10 @@
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, Integer, String, Boolean, DECIMAL
+import pandas as pd
+import threading
+import time
 
+from pf_manager.db.cache import query_cache
 from pf_manager.db.orm import _session, BaseDAOModel
 
 
@@ -27,8 +31,121 @@ class Entity(declarative_base()):
     price_overwrite = Column(DECIMAL(40, 8))
 
 
+class ReferenceIndex:
+    """
+    Immutable in-memory snapshot of reference_data for symbol translation without a database round trip.
+    Rows are indexed by each of the LOOKUP_FIELDS, and the ids of active rows, and of rows per
+    asset_class and main_country, are precomputed so that ticker lists are set intersections.
+    Where a value is shared by several rows, the row with the lowest id wins.
+    """
+    # Same type names as DAO.get_ticker_type, plus the name columns
+    LOOKUP_FIELDS = {
+        "yahoo": "yahoo_ticker",
+        "google": "google_ticker",
+        "tv": "tradingview_ticker",
+        "name": "name",
+        "short_name_grouped": "short_name_grouped"
+    }
+
+    def __init__(self, ref: pd.DataFrame):
+        self.loaded_at = time.monotonic()
+        ref = ref.sort_values("id") if not ref.empty else ref
+        self._rows = {
+            x["id"]: x
+            for x in ref.astype(object).where(ref.notna(), None).to_dict(
+                orient="records")
+        }
+        self._by = {type: {} for type in self.LOOKUP_FIELDS}
+        self._active = set()
+        self._by_asset_class = {}
+        self._by_country = {}
+        for id, row in self._rows.items():
+            for type, field in self.LOOKUP_FIELDS.items():
+                if row[field] is not None:
+                    self._by[type].setdefault(row[field], row)
+            if row["active"]:
+                self._active.add(id)
+            self._by_asset_class.setdefault(row["asset_class"], set()).add(id)
+            self._by_country.setdefault(row["main_country"], set()).add(id)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def get(self, value: str, type: str = "yahoo") -> dict:
+        """ Reference data row with value in the column of the given type, None if unknown """
+        return self._by[self._check_type(type)].get(value)
+
+    def translate(self, value: str, type: str = "yahoo",
+                  to: str = "name") -> str:
+        """ e.g. translate("ES3.SI", "yahoo", "tv") """
+        row = self.get(value, type)
+        return row[self.LOOKUP_FIELDS[self._check_type(to)]] if row else None
+
+    def tickers(self,
+                type: str = "yahoo",
+                active: bool = True,
+                asset_class: str = None,
+                country: str = None,
+                dropna: bool = True) -> list:
+        """
+        Distinct values of the column of the given type, in id order.
+        active: True/False to filter on the active flag, None for all rows
+        """
+        field = self.LOOKUP_FIELDS[self._check_type(type)]
+        ids = set(self._rows)
+        if active is not None:
+            ids = ids & self._active if active else ids - self._active
+        if asset_class is not None:
+            ids &= self._by_asset_class.get(asset_class, set())
+        if country is not None:
+            ids &= self._by_country.get(country, set())
+
+        res = dict.fromkeys(self._rows[id][field] for id in sorted(ids))
+        return [x for x in res if x is not None or not dropna]
+
+    def _check_type(self, type: str) -> str:
+        if type not in self.LOOKUP_FIELDS:
+            raise ValueError(f"{type} is not a supported lookup type")
+        return type
+
+
+_index = None
+_index_version = 0
+_index_lock = threading.Lock()
+
+
+def _drop_index():
+    """ Fired by query_cache whenever reference_data is written to """
+    global _index, _index_version
+    with _index_lock:
+        _index = None
+        _index_version += 1
+
+
+query_cache.subscribe(Entity.__tablename__, _drop_index)
+
+
 class DAO(BaseDAOModel):
     Entity = Entity
+    # Seconds before the in-memory index is reloaded, catches writes made by other processes
+    index_ttl = 300.
+
+    @classmethod
+    def index(cls) -> ReferenceIndex:
+        """ The in-memory reference data index, loaded on first use and after every write to the table """
+        global _index
+        index = _index
+        if index is not None and time.monotonic(
+        ) - index.loaded_at < cls.index_ttl:
+            return index
+
+        version = _index_version
+        index = ReferenceIndex(cls.get())
+        with _index_lock:
+            # Do not publish an index that was loaded while the table was being written to
+            if version == _index_version:
+                _index = index
+        return index
 
     @classmethod
     def insert(cls, entity):
@@ -36,6 +153,7 @@ class DAO(BaseDAOModel):
             ss.add(entity)
             ss.flush()
             ss.refresh(entity)
+            cls.invalidate_cache(ss)
 
     @classmethod
     def del_by_ticker(cls, type: str = "yahoo", ticker: str = None):
@@ -43,12 +161,12 @@ class DAO(BaseDAOModel):
             ss.query(Entity).filter(
                 cls.get_ticker_type(type) == ticker).delete(
                     synchronize_session=False)
+            cls.invalidate_cache(ss)
 
     @classmethod
     def get_distinct_tickers(cls, type: str = "yahoo", active: bool = True):
-        with _session() as ss:
-            return ss.query(cls.get_ticker_type(type)).filter(
-                Entity.active == active).distinct().all()
+        return [(x, ) for x in cls.index().tickers(
+            type, active=active, dropna=False)]
 
     @classmethod
     def get_ticker_type(cls, type: str = "yahoo"):
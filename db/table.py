@@ -1,23 +1,33 @@
-""" This script creates the tables in the database based on the object classes 
+""" This script creates the tables in the database based on the object classes
 Entity refers to any of the entities in pf_manager.db.entity module
+engine defaults to the process-wide pooled engine of the default database, see db.get_engine
 """
 
-from pf_manager.db import sqlalchemy_engine
+from pf_manager.db import get_engine
+from pf_manager.db.entity import Base
 
-engine = sqlalchemy_engine()  # Make this global
 
-
-def create_table(Entity):
+def create_table(Entity, engine=None):
     """ Entity is one of the entities in brahms.db.entity """
-    Entity.__table__.create(bind=engine, checkfirst=True)
+    Entity.__table__.create(bind=engine or get_engine(), checkfirst=True)
 
 
-def drop_table(Entity):
+def drop_table(Entity, engine=None):
     """ Entity is one of the entities in brahms.db.entity. Be careful with this fn! """
-    Entity.__table__.drop(bind=engine, checkfirst=True)
+    Entity.__table__.drop(bind=engine or get_engine(), checkfirst=True)
 
 
-def recreate_table(Entity, drop_table_flag=True):
+def recreate_table(Entity, drop_table_flag=True, engine=None):
     if drop_table_flag:
-        drop_table(Entity)
-    create_table(Entity)
\ No newline at end of file
+        drop_table(Entity, engine=engine)
+    create_table(Entity, engine=engine)
+
+
+def recreate_tables(Entities: list, drop_table_flag=True, engine=None):
+    """ recreate_table for several entities in a single DDL pass over one connection """
+    engine = engine or get_engine()
+    tables = [x.__table__ for x in Entities]
+    with engine.begin() as conn:
+        if drop_table_flag:
+            Base.metadata.drop_all(bind=conn, tables=tables, checkfirst=True)
+        Base.metadata.create_all(bind=conn, tables=tables, checkfirst=True)
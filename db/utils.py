@@ -1,34 +1,66 @@
+import numpy as np
 import pandas as pd
 from pandas.core.frame import DataFrame
+from sqlalchemy import types as sqltypes
 
+from pf_manager.db.dtypes import csv_dtypes, materialize
 
-def entity_to_df(rows):
+
+def entity_to_df(rows, Entity=None):
     """
-    convert a list of entity object to DataFrame
-    TODO(x) to be backward compatible, DataFrame should always have columns even if it's empty.
+    convert a list of entity object to DataFrame, column by column.
+    Entity supplies the columns when rows is empty, to be backward compatible the DataFrame
+    always has columns if either rows or Entity is given.
+    Prefer query_to_df where the query is available, it avoids hydrating entities altogether.
     """
-    d = {}
-    n = 0
-    if rows is not None:
-        for row in rows:
-            d[n] = entity_to_dict(row)
-            n += 1
-    return pd.DataFrame.from_dict(d, orient='index')
+    rows = list(rows) if rows is not None else []
+    if rows:
+        Entity = type(rows[0])
+    if Entity is None:
+        return pd.DataFrame()
+    columns = entity_columns(Entity)
+    return _rows_to_df([tuple(getattr(r, c) for c in columns) for r in rows],
+                       columns)
 
 
-def _resultproxy_to_df(rp):
+def _resultproxy_to_df(rp, columns: list = None):
     """
     1. session.execute() returns a ResultProxy
     2. ResultProxy if it doesn't query ORM class.
     For ease of use, let's convert ResultProxy to DataFrame before returning.
+    columns is used when rp is a list of rows and is empty.
     """
-    d = {}
-    n = 0
-    if rp is not None:
-        for row in rp:
-            d[n] = dict(zip(row.keys(), row))
-            n += 1
-    return pd.DataFrame.from_dict(d, orient='index')
+    if rp is None:
+        return pd.DataFrame(columns=columns)
+    if isinstance(rp, (list, tuple)):
+        rows = rp
+        if rows:
+            columns = list(rows[0].keys())
+    else:
+        columns = list(rp.keys())
+        rows = rp.fetchall()
+    return _rows_to_df(rows, columns)
+
+
+def query_to_df(query_obj, typed: bool = False) -> DataFrame:
+    """
+    Execute a query and convert the raw row tuples to a DataFrame column by column.
+    Single entity queries are rewritten to select the entity's table columns, so no ORM objects are built.
+    Empty results still carry the selected columns.
+    typed: convert DECIMAL columns to float64 and low cardinality strings to categoricals, see db.dtypes
+    """
+    descriptions = query_obj.column_descriptions
+    if len(descriptions) == 1 and isinstance(descriptions[0]["expr"], type) \
+            and hasattr(descriptions[0]["expr"], "__table__"):
+        table_columns = descriptions[0]["expr"].__table__.columns
+        query_obj = query_obj.with_entities(*table_columns)
+        columns = [c.name for c in table_columns]
+        types = {c.name: c.type for c in table_columns}
+    else:
+        columns = [x["name"] for x in descriptions]
+        types = {x["name"]: x["type"] for x in descriptions}
+    df = _rows_to_df(query_obj.all(), columns)
+    return materialize(df, types) if typed else df
 
 
 def entity_to_dict(r):
@@ -38,6 +70,69 @@ def entity_to_dict(r):
     return d
 
 
+def entity_columns(Entity) -> list:
+    return [c.name for c in Entity.__table__.columns]
+
+
+def _rows_to_df(rows, columns) -> DataFrame:
+    """ Transpose row tuples into column lists, which pandas ingests much faster than dicts per row """
+    if not rows:
+        return pd.DataFrame(columns=columns)
+    return pd.DataFrame(dict(zip(columns, map(list, zip(*rows)))),
+                        columns=columns)
+
+
+def _df_to_columns(data, Entity) -> dict:
+    """
+    Inverse of _rows_to_df for bulk writes. data is a DataFrame or a dict of column arrays.
+    Returns column name to list of python values, missing values as None, and dates converted
+    according to the column type of the Entity. Raises ValueError on columns the Entity does not have.
+    """
+    if not isinstance(data, DataFrame):
+        data = pd.DataFrame(data)
+    types = {c.name: c.type for c in Entity.__table__.columns}
+    unknown = [x for x in data.columns if x not in types]
+    if unknown:
+        raise ValueError(
+            f"{unknown} are not columns of {Entity.__tablename__}")
+
+    res = {}
+    for col in data.columns:
+        values = data[col]
+        if pd.api.types.is_datetime64_any_dtype(values):
+            if isinstance(types[col], sqltypes.DateTime):
+                values = pd.Series(values.dt.to_pydatetime(), dtype=object)
+            else:
+                values = values.dt.date
+        values = values.astype(object)
+        # tolist converts numpy scalars to their python equivalents, which every dbapi accepts
+        res[col] = np.where(values.notna(), values, None).tolist()
+    return res
+
+
+def read_csv_chunks(path: str,
+                    Entity,
+                    chunksize: int = 50000,
+                    date_format: str = None,
+                    **kwargs):
+    """
+    Stream a csv of an ORM entity as typed DataFrames of at most chunksize rows, so memory stays flat
+    regardless of the file size. Dtypes follow the column types of the Entity, see db.dtypes.csv_dtypes.
+    Date columns are parsed per chunk with pd.to_datetime, date_format (e.g. "%d-%b-%y") avoids
+    format inference, otherwise parsing is cached per distinct value.
+    kwargs are passed on to pd.read_csv
+    """
+    dtypes, dates = csv_dtypes(Entity)
+    for chunk in pd.read_csv(path,
+                             dtype=dtypes,
+                             chunksize=chunksize,
+                             **kwargs):
+        for col in dates:
+            if col in chunk:
+                chunk[col] = pd.to_datetime(chunk[col], format=date_format)
+        yield chunk
+
+
 def dao_entity_generators(tableName: str,
                           path: str = None,
                           df: DataFrame = None):
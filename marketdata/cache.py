@@ -0,0 +1,111 @@
+"""
+PageCache is a small on-disk cache for scraped market data pages. Each key (usually a ticker) is
+stored in its own pickle file together with the http validators (ETag / Last-Modified) and a content
+hash of the raw page, so unchanged pages can skip both the download and the parse.
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+import re
+import tempfile
+import time
+
+
+class PageCache:
+    """
+    path: directory holding one pickle file per key
+    ttl: seconds since an entry was last validated before it is evicted
+    Entry fields: frame, etag, last_modified, content_hash, validated_at
+    """
+    def __init__(self, path: str, ttl: int = 7 * 24 * 60 * 60):
+        self.path = path
+        self.ttl = ttl
+        os.makedirs(path, exist_ok=True)
+
+    def get(self, key: str) -> dict:
+        """ Returns the entry for key, or None if it is missing, unreadable or expired """
+        filepath = self._filepath(key)
+        try:
+            with open(filepath, "rb") as f:
+                entry = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"Discarding unreadable cache entry {key}: {e}")
+            self._remove(filepath)
+            return None
+
+        if self._expired(entry):
+            self._remove(filepath)
+            return None
+        return entry
+
+    def put(self,
+            key: str,
+            frame,
+            etag: str = None,
+            last_modified: str = None,
+            content_hash: str = None) -> None:
+        entry = {
+            "frame": frame,
+            "etag": etag,
+            "last_modified": last_modified,
+            "content_hash": content_hash,
+            "validated_at": time.time()
+        }
+        # Write to a temp file first so that readers never see a partial entry
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self._filepath(key))
+        except Exception:
+            self._remove(tmp)
+            raise
+
+    def evict(self) -> int:
+        """ Remove all expired entries, returns the number of entries removed """
+        removed = 0
+        for filename in os.listdir(self.path):
+            if not filename.endswith(".pkl"):
+                continue
+            filepath = os.path.join(self.path, filename)
+            try:
+                with open(filepath, "rb") as f:
+                    expired = self._expired(pickle.load(f))
+            except Exception:
+                expired = True
+            if expired:
+                self._remove(filepath)
+                removed += 1
+        return removed
+
+    @staticmethod
+    def content_hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def conditional_headers(entry: dict) -> dict:
+        """ Http headers for a conditional GET based on a cached entry """
+        headers = {}
+        if entry:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def _expired(self, entry: dict) -> bool:
+        return time.time() - entry.get("validated_at", 0) > self.ttl
+
+    def _filepath(self, key: str) -> str:
+        return os.path.join(self.path, re.sub(r'[^\w.-]', '_', key) + ".pkl")
+
+    @staticmethod
+    def _remove(filepath: str) -> None:
+        try:
+            os.remove(filepath)
+        except OSError:
+            pass
@@ -1,40 +1,260 @@
-from aiohttp import ClientSession
+from aiohttp import ClientSession, TCPConnector
 import asyncio
+import concurrent.futures
 from bs4 import BeautifulSoup
 from collections import deque
+from functools import partial
+from html.parser import HTMLParser
+import logging
+import os
 import pandas as pd
 import re
 
+from pf_manager.db import run_sync
 from pf_manager.db.orm.reference_data import DAO
+from pf_manager.marketdata.cache import PageCache
 
+_TABLE_START = re.compile(r'<table\b', re.IGNORECASE)
+_TABLE_END = re.compile(r'</table\s*>', re.IGNORECASE)
 
-class DividendManager:
+
+class _TableParser(HTMLParser):
+    """ 
+    Minimal tokenizer for a single html table. 
+    rows: list of [(tag, rowspan, text)] per <tr>
+    headers: text of every <th> in the table
+    """
     def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.rows = []
+        self.headers = []
+        self._row = None
+        self._cell = None
+        self._depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "table":
+            self._depth += 1
+            if self._depth > 1:
+                raise ValueError("Nested tables are not supported")
+        elif tag == "tr":
+            self._close_row()
+            self._row = []
+        elif tag in ("td", "th"):
+            self._close_cell()
+            self._cell = (tag, dict(attrs).get("rowspan"), [])
+
+    def handle_endtag(self, tag):
+        if tag in ("td", "th"):
+            self._close_cell()
+        elif tag == "tr":
+            self._close_row()
+        elif tag == "table":
+            self._close_row()
+            self._depth -= 1
+
+    def handle_data(self, data):
+        if self._cell is not None:
+            self._cell[2].append(data)
+
+    def _close_cell(self):
+        if self._cell is None:
+            return
+        tag, rs, text = self._cell
+        text = "".join(text)
+        if tag == "th":
+            self.headers.append(text)
+        if self._row is not None:
+            self._row.append((tag, rs, text))
+        self._cell = None
+
+    def _close_row(self):
+        self._close_cell()
+        if self._row is not None:
+            self.rows.append(self._row)
+        self._row = None
+
+
+class DividendManager:
+    """ 
+    Scrapes dividend history from dividends.sg. 
+    concurrency: maximum number of in-flight requests in get_all
+    limit_per_host: maximum number of pooled connections per host
+    parse_workers: offload html parsing to a process pool of this size, parse inline if None
+    cache_dir: cache pages on disk by ticker, conditional requests and content hashes are used
+               to skip unchanged pages. No caching if None
+    cache_ttl: seconds before a cached page that has not been revalidated is evicted
+    """
+    def __init__(self,
+                 concurrency: int = 20,
+                 limit_per_host: int = 10,
+                 parse_workers: int = None,
+                 cache_dir: str = None,
+                 cache_ttl: int = 7 * 24 * 60 * 60):
         self.URL = "https://www.dividends.sg/view/"
+        self.concurrency = concurrency
+        self.limit_per_host = limit_per_host
+        self.parse_workers = parse_workers
+        self._parse_pool = None
+        self._cache = PageCache(cache_dir, ttl=cache_ttl) if cache_dir else None
+
+    async def get_all(self) -> pd.DataFrame:
+        """ Scrape dividends for all active singapore equities over a single pooled session """
+        # The first call loads the reference data index from the database
+        index = await run_sync(DAO.index)
+        relevant_sg_tickers = index.tickers("yahoo",
+                                            active=True,
+                                            asset_class="equity",
+                                            country="singapore")
+        if not relevant_sg_tickers:
+            return pd.DataFrame()
+        tickers = {self._to_sgx_ticker(x) for x in relevant_sg_tickers}
+
+        if self._cache:
+            # Expired entries are otherwise only dropped when their ticker is read again,
+            # which never happens for delisted tickers
+            loop = asyncio.get_event_loop()
+            evicted = await loop.run_in_executor(None, self._cache.evict)
+            logging.info(f"Evicted {evicted} expired dividend pages")
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        connector = TCPConnector(limit=self.concurrency,
+                                 limit_per_host=self.limit_per_host)
+        async with ClientSession(connector=connector) as session:
+            results = await asyncio.gather(*[
+                self.get(ticker, session=session, semaphore=semaphore)
+                for ticker in sorted(tickers)
+            ])
 
-    async def get_all():
-        relevant_sg_tickers = DAO.get(where=[("main_country", "singapore"),
-                                             ("active", True),
-                                             ("asset_class", "equity")],
-                                      cols=["yahoo_ticker"])
-        raise NotImplementedError()
+        results = [x for x in results if not x.empty]
+        if not results:
+            return pd.DataFrame()
+        return pd.concat(results, ignore_index=True)
+
+    async def get(self,
+                  ticker: str = "AJBU",
+                  session: ClientSession = None,
+                  semaphore: asyncio.Semaphore = None) -> pd.DataFrame:
+        """ 
+        Reuses the caller's session if supplied, otherwise opens a new one.
+        The semaphore only guards the download, so parsing does not hold up other requests.
+        """
+        if session is None:
+            async with ClientSession() as session:
+                return await self.get(ticker, session=session)
 
-    async def get(self, ticker: str = "AJBU") -> pd.DataFrame:
         url = self.URL + ticker
         results = pd.DataFrame()
-        async with ClientSession() as session:
-            async with session.get(url) as response:
-                try:
+        # Cache reads and writes are file io and unpickling, keep them off the event loop
+        loop = asyncio.get_event_loop()
+        entry = await loop.run_in_executor(
+            None, self._cache.get, ticker) if self._cache else None
+        try:
+            async with semaphore or asyncio.Semaphore():
+                async with session.get(
+                        url,
+                        headers=PageCache.conditional_headers(
+                            entry)) as response:
                     response.raise_for_status()
                     print(f"Response status ({url}): {response.status}")
-                    response_txt = await response.text()
-                    results = self.parse(response_txt)
+                    not_modified = response.status == 304
+                    response_txt = None
+                    if not not_modified:
+                        response_txt = await response.text()
+                    etag = response.headers.get("ETag")
+                    last_modified = response.headers.get("Last-Modified")
+
+            content_hash = None
+            if not_modified and entry:
+                # 304 responses may omit the validators, keep the cached ones
+                results = entry["frame"]
+                content_hash = entry["content_hash"]
+                etag = etag or entry["etag"]
+                last_modified = last_modified or entry["last_modified"]
+            else:
+                content_hash = PageCache.content_hash(response_txt)
+                if entry and entry["content_hash"] == content_hash:
+                    results = entry["frame"]
+                else:
+                    results = await self._parse_async(response_txt)
                     results["ticker"] = ticker
-                except Exception as e:
-                    print(f"An error has occured: {e}")
+
+            if self._cache:
+                # Always rewrite so that the validators and ttl are refreshed
+                await loop.run_in_executor(
+                    None,
+                    partial(self._cache.put,
+                            ticker,
+                            results,
+                            etag=etag,
+                            last_modified=last_modified,
+                            content_hash=content_hash))
+            results = results.copy()
+        except Exception as e:
+            print(f"An error has occured: {e}")
         return results
 
-    def parse(self, response_txt: str) -> pd.DataFrame:
+    def close(self) -> None:
+        """ Shut down the parse process pool, if one was started """
+        if self._parse_pool is not None:
+            self._parse_pool.shutdown()
+            self._parse_pool = None
+
+    async def _parse_async(self, response_txt: str) -> pd.DataFrame:
+        if not self.parse_workers:
+            return self.parse(response_txt)
+
+        if self._parse_pool is None:
+            self._parse_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.parse_workers)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._parse_pool,
+                                          DividendManager.parse,
+                                          response_txt)
+
+    @staticmethod
+    def parse(response_txt: str) -> pd.DataFrame:
+        """ Parse the dividends table, falling back to BeautifulSoup if the fast parser fails """
+        try:
+            return DividendManager._parse_fast(response_txt)
+        except Exception as e:
+            logging.debug(f"Fast parser failed, falling back to bs4: {e}")
+            return DividendManager._parse_bs4(response_txt)
+
+    @staticmethod
+    def _parse_fast(response_txt: str) -> pd.DataFrame:
+        """ Tokenizes only the first <table> and resolves rowspans with plain lists """
+        start = _TABLE_START.search(response_txt)
+        end = _TABLE_END.search(response_txt, start.end()) if start else None
+        if not end:
+            raise ValueError("No table found in response")
+
+        parser = _TableParser()
+        parser.feed(response_txt[start.start():end.end()])
+        parser.close()
+
+        data = []
+        rowspan_handler = []
+        for row in parser.rows:
+            # Column Names
+            if any(tag == "th" for tag, _, _ in row):
+                data.append(parser.headers)
+                rowspan_handler = [[] for _ in parser.headers]
+            # Column Data
+            else:
+                cols = [(text, rs) for tag, rs, text in row if tag == "td"]
+                for i, stack in enumerate(rowspan_handler):
+                    if stack:
+                        # Handle data spanning > 1 row
+                        cols.insert(i, (stack.pop(), None))
+                for i, (text, rs) in enumerate(cols):
+                    if rs:
+                        rowspan_handler[i].extend([text] * (int(rs) - 1))
+                data.append([text.strip() for text, _ in cols])
+        return DividendManager._to_frame(data)
+
+    @staticmethod
+    def _parse_bs4(response_txt: str) -> pd.DataFrame:
         soup = BeautifulSoup(response_txt, 'html.parser')
         table = soup.find("table")
         rows = table.find_all("tr")
@@ -66,6 +286,11 @@ class DividendManager:
                             for _ in range(int(rs) - 1)
                         ]
                 data.append([ele.text.strip() for ele in cols])
+        return DividendManager._to_frame(data)
+
+    @staticmethod
+    def _to_frame(data: list) -> pd.DataFrame:
+        """ First row of data is the header, amounts are summed on ex date and pay date """
         results = pd.DataFrame(data[1:], columns=data[0])
 
         def parseAmount(val):
@@ -85,11 +310,20 @@ class DividendManager:
         response = requests.get(self.URL + ticker).text
         return self.parse(response)
 
+    @staticmethod
+    def _to_sgx_ticker(yahoo_ticker: str) -> str:
+        """ dividends.sg uses the SGX code without the yahoo exchange suffix, e.g. ES3.SI -> ES3 """
+        return yahoo_ticker.split(".")[0].upper()
+
 
 if __name__ == "__main__":
     # htmls = asyncio.gather(*tasks)
-    dm = DividendManager()
+    dm = DividendManager(parse_workers=4,
+                         cache_dir=os.path.join(os.path.dirname(__file__),
+                                                "..", ".cache", "dividends"))
     # print(dm.get_sync())
 
     loop = asyncio.get_event_loop()
     loop.run_until_complete(dm.get(ticker="AJBU"))
+    print(loop.run_until_complete(dm.get_all()))
+    dm.close()
@@ -1,29 +1,155 @@
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector
+import asyncio
+import datetime
+from functools import partial
 import json
 import logging
+import os
+import numpy as np
+import pandas as pd
 import requests
 
-from pf_manager.db import sqlalchemy_engine_session, dao
-from pf_manager.db.utils import entity_to_df
+from pf_manager.db import run_sync
+from pf_manager.db.orm import reference_data
+from pf_manager.marketdata.history import PriceHistoryStore
 
 
 class EodPriceManager:
-    """ This class controls the extraction of market data via http protocol """
-    def __init__(self):
+    """ 
+    This class controls the extraction of market data via http protocol 
+    concurrency: maximum number of in-flight requests in get_all
+    limit_per_host: maximum number of pooled connections per host
+    timeout: seconds before a single request is abandoned
+    retries: number of retries on timeouts, connection errors and 429/5xx responses
+    """
+    def __init__(self,
+                 concurrency: int = 20,
+                 limit_per_host: int = 10,
+                 timeout: float = 10.,
+                 retries: int = 3):
         self._yahoo_address = "https://query1.finance.yahoo.com/v8/finance/chart"
         self._yahoo_relevant_fields = [
             "regularMarketPrice", "symbol", "previousClose"
         ]
-        self._reference_dao = dao.get_ReferenceData_dao()
+        self.concurrency = concurrency
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = 0.5
 
-    def get_all(self):
-        tickers = self._get_relevant_tickers()
-        for ticker in tickers:
-            # TODO: make this async with asyncio
-            print(ticker)
+    async def get_all(self) -> pd.DataFrame:
+        """ Latest market data for all active tickers, indexed by ticker """
+        tickers = await run_sync(self._get_relevant_tickers)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        connector = TCPConnector(limit=self.concurrency,
+                                 limit_per_host=self.limit_per_host)
+        async with ClientSession(
+                connector=connector,
+                timeout=ClientTimeout(total=self.timeout)) as session:
+            results = await asyncio.gather(*[
+                self.get_market_data_async(ticker, session, semaphore)
+                for ticker in tickers
+            ])
+
+        records = {}
+        for ticker, res in zip(tickers, results):
+            if res.get("error"):
+                logging.error(
+                    f"{ticker} can't be queried from api: {res['error']}")
+            else:
+                records[ticker] = res
+        return pd.DataFrame.from_dict(records,
+                                      orient="index",
+                                      columns=self._yahoo_relevant_fields)
+
+    async def refresh_history(
+            self,
+            store: PriceHistoryStore,
+            tickers: list = None,
+            start: datetime.date = datetime.date(2015, 1, 1)) -> dict:
+        """ 
+        Download only the dates missing from the store for each ticker and append them.
+        The last stored date is downloaded again and replaced, since it may have been stored
+        while its session was still trading.
+        Tickers default to all active tickers, returns the number of rows written per ticker.
+        """
+        tickers = tickers or await run_sync(self._get_relevant_tickers)
+        edt = datetime.date.today()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        connector = TCPConnector(limit=self.concurrency,
+                                 limit_per_host=self.limit_per_host)
+
+        loop = asyncio.get_event_loop()
+
+        async def refresh(ticker, session):
+            # The store reads and rewrites whole files, keep that off the event loop
+            sdt = await loop.run_in_executor(None, store.last_date,
+                                             ticker) or start
+            if sdt > edt:
+                return 0
             try:
-                print(self.get_market_data(ticker))
-            except:
-                logging.error(f"{ticker} can't be queried from api")
+                history = await self.get_history_async(ticker, session, sdt,
+                                                       edt, semaphore)
+            except Exception as e:
+                logging.error(f"{ticker} history can't be queried from api: {e}")
+                return 0
+            return await loop.run_in_executor(
+                None, partial(store.append, ticker, history,
+                              overwrite_from=sdt))
+
+        async with ClientSession(
+                connector=connector,
+                timeout=ClientTimeout(total=self.timeout)) as session:
+            results = await asyncio.gather(
+                *[refresh(ticker, session) for ticker in tickers])
+        return dict(zip(tickers, results))
+
+    async def get_history_async(
+            self,
+            ticker: str,
+            session: ClientSession,
+            sdt: datetime.date,
+            edt: datetime.date,
+            semaphore: asyncio.Semaphore = None) -> pd.DataFrame:
+        """ Daily open, high, low, close, adjclose and volume between sdt and edt inclusive """
+        epoch = datetime.date(1970, 1, 1)
+        params = {
+            "period1": (sdt - epoch).days * 86400,
+            "period2": (edt - epoch).days * 86400 + 86400,
+            "interval": "1d",
+            "events": "div,split"
+        }
+        res = await self._fetch_json(session,
+                                     f"{self._yahoo_address}/{ticker}",
+                                     params=params,
+                                     semaphore=semaphore)
+        chart = res.get("chart") or {}
+        if res.get("error") or chart.get("error"):
+            raise Exception(res.get("error") or chart.get("error"))
+        return self._parse_history(chart.get("result")[0])
+
+    @staticmethod
+    def _parse_history(result: dict) -> pd.DataFrame:
+        timestamps = result.get("timestamp") or []
+        if not timestamps:
+            return pd.DataFrame()
+        # Shift to exchange local time before truncating to a date
+        offset = (result.get("meta") or {}).get("gmtoffset") or 0
+        indicators = result.get("indicators") or {}
+        quote = (indicators.get("quote") or [{}])[0]
+        adjclose = (indicators.get("adjclose") or [{}])[0].get("adjclose")
+
+        history = pd.DataFrame({
+            "date":
+            (np.array(timestamps, dtype="int64") + offset).astype(
+                "datetime64[s]").astype("datetime64[D]")
+        })
+        for field in ["open", "high", "low", "close", "volume"]:
+            history[field] = np.array(quote.get(field) or np.nan,
+                                      dtype="float64")
+        history["adjclose"] = np.array(
+            adjclose if adjclose else history["close"], dtype="float64")
+        return history
 
     def get_market_data(self,
                         ticker: str = "ES3.SI") -> requests.models.Response:
@@ -31,24 +157,64 @@ class EodPriceManager:
         resp = requests.get(api)
         logging.info(f'get ticker data from api')
 
-        res = json.loads(resp.text)
-        status = res.get("error")
+        return self._parse_meta(json.loads(resp.text))
+
+    async def get_market_data_async(
+            self,
+            ticker: str,
+            session: ClientSession,
+            semaphore: asyncio.Semaphore = None) -> dict:
+        """ Async counterpart of get_market_data over a shared session """
+        try:
+            res = await self._fetch_json(session, f"{self._yahoo_address}/{ticker}",
+                                         semaphore=semaphore)
+        except Exception as e:
+            return {"error": str(e) or type(e).__name__}
+        return self._parse_meta(res)
+
+    async def _fetch_json(self,
+                          session: ClientSession,
+                          url: str,
+                          params: dict = None,
+                          semaphore: asyncio.Semaphore = None) -> dict:
+        """ GET a json payload, retrying with exponential backoff on transient failures """
+        for attempt in range(self.retries + 1):
+            try:
+                async with semaphore or asyncio.Semaphore():
+                    async with session.get(url, params=params) as resp:
+                        if resp.status == 429 or resp.status >= 500:
+                            resp.raise_for_status()
+                        # Yahoo returns json error bodies for 4xx, e.g. invalid tickers
+                        return await resp.json(content_type=None)
+            except (ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.retries:
+                    raise
+                logging.warning(
+                    f"Retrying {url} ({attempt + 1}/{self.retries}): {e!r}")
+                await asyncio.sleep(self.backoff * 2**attempt)
+
+    def _parse_meta(self, res: dict) -> dict:
+        chart = res.get("chart") or {}
+        status = res.get("error") or chart.get("error")
 
         if not status:
-            meta = res.get("chart").get("result")[0].get("meta")
+            meta = chart.get("result")[0].get("meta")
             return {x: meta.get(x) for x in self._yahoo_relevant_fields}
         else:
             return {"error": status}
 
     def _get_relevant_tickers(self):
-        with sqlalchemy_engine_session() as session:
-            ref = entity_to_df(self._reference_dao.mget_all(session))
-            ref = ref[ref["active"]]
-        return [x for x in list((ref["yahoo_ticker"])) if x]
+        return reference_data.DAO.index().tickers("yahoo", active=True)
 
 
 if __name__ == "__main__":
     epm = EodPriceManager()
     print(epm._get_relevant_tickers())
     print(epm.get_market_data("ES3.SI"))
-    epm.get_all()
+    loop = asyncio.get_event_loop()
+    print(loop.run_until_complete(epm.get_all()))
+
+    store = PriceHistoryStore(
+        os.path.join(os.path.dirname(__file__), "..", ".cache", "prices"))
+    print(loop.run_until_complete(epm.refresh_history(store)))
+    print(store.read(epm._get_relevant_tickers()).tail())
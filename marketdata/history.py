@@ -0,0 +1,120 @@
+"""
+PriceHistoryStore keeps daily price history on disk, one NumPy file per ticker. Each file holds a
+structured array sorted by date, which is memory-mapped on read so that building a dates x tickers
+matrix only touches the requested date range.
+"""
+
+import datetime
+import os
+import re
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+PRICE_DTYPE = np.dtype([("date", "datetime64[D]"), ("open", "f8"),
+                        ("high", "f8"), ("low", "f8"), ("close", "f8"),
+                        ("adjclose", "f8"), ("volume", "f8")])
+PRICE_FIELDS = [x for x in PRICE_DTYPE.names if x != "date"]
+
+
+class PriceHistoryStore:
+    """
+    path: directory holding one <ticker>.npy file per ticker
+    Methods:
+    last_date: latest date stored for a ticker, None if there is no history
+    append: add rows after the last stored date, optionally replacing rows from a given date
+    load: full structured array for a ticker
+    read: dates x tickers DataFrame for a single price field
+    """
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def last_date(self, ticker: str) -> datetime.date:
+        arr = self.load(ticker)
+        if len(arr) == 0:
+            return None
+        return arr["date"][-1].astype(datetime.date)
+
+    def load(self, ticker: str, mmap: bool = True) -> np.ndarray:
+        filepath = self._filepath(ticker)
+        if not os.path.exists(filepath):
+            return np.empty(0, dtype=PRICE_DTYPE)
+        return np.load(filepath, mmap_mode="r" if mmap else None)
+
+    def append(self,
+               ticker: str,
+               frame: pd.DataFrame,
+               overwrite_from: datetime.date = None) -> int:
+        """
+        frame requires a date column and any of the PRICE_FIELDS, missing fields are stored as NaN.
+        Only rows dated after the last stored date are appended, returns the number of rows written.
+        overwrite_from: stored rows dated on or after this date are replaced by the rows of frame
+                        from that date on, e.g. to replace the partial bar of an unfinished session.
+                        Nothing is replaced if frame has no rows from that date on
+        """
+        if frame is None or frame.empty:
+            return 0
+
+        new = np.empty(len(frame), dtype=PRICE_DTYPE)
+        new["date"] = pd.to_datetime(frame["date"]).values.astype(
+            "datetime64[D]")
+        for field in PRICE_FIELDS:
+            new[field] = frame[field].values if field in frame else np.nan
+        # Stable, so that rows of a repeated date keep the order of the source
+        new = new[np.argsort(new["date"], kind="stable")]
+
+        existing = self.load(ticker, mmap=False)
+        if overwrite_from is not None:
+            overwrite_from = np.datetime64(overwrite_from, "D")
+            new = new[new["date"] >= overwrite_from]
+            if len(new) == 0:
+                return 0
+            existing = existing[existing["date"] < overwrite_from]
+        if len(existing):
+            new = new[new["date"] > existing["date"][-1]]
+        # Keep the last row per date if the source repeats a date
+        if len(new):
+            keep = np.append(new["date"][1:] != new["date"][:-1], True)
+            new = new[keep]
+        if len(new) == 0:
+            return 0
+
+        self._write(ticker, np.concatenate([existing, new]))
+        return len(new)
+
+    def read(self,
+             tickers: list,
+             sdt: datetime.date = None,
+             edt: datetime.date = None,
+             field: str = "close") -> pd.DataFrame:
+        """ Dates x tickers matrix of a single field, dates where a ticker has no data are NaN """
+        assert field in PRICE_FIELDS
+        series = {}
+        for ticker in tickers:
+            arr = self.load(ticker)
+            dates = arr["date"]
+            lo = 0 if sdt is None else np.searchsorted(
+                dates, np.datetime64(sdt, "D"), side="left")
+            hi = len(arr) if edt is None else np.searchsorted(
+                dates, np.datetime64(edt, "D"), side="right")
+            series[ticker] = pd.Series(np.array(arr[field][lo:hi]),
+                                       index=pd.DatetimeIndex(dates[lo:hi]))
+        res = pd.DataFrame(series, columns=list(tickers))
+        res.index.name = "date"
+        return res.sort_index()
+
+    def _write(self, ticker: str, arr: np.ndarray) -> None:
+        # Write to a temp file first so that memory-mapped readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, arr)
+            os.replace(tmp, self._filepath(ticker))
+        except Exception:
+            os.remove(tmp)
+            raise
+
+    def _filepath(self, ticker: str) -> str:
+        return os.path.join(self.path, re.sub(r'[^\w.-]', '_', ticker) + ".npy")
@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 
+import datetime
 import logging
+import numpy as np
 import pandas as pd
 
 from pf_manager.db import sqlalchemy_engine_session, dao
-from pf_manager.db.utils import entity_to_df
+from pf_manager.db.orm import blotter as orm_blotter
+from pf_manager.db.utils import query_to_df
+from pf_manager.portfolio.positions import PositionIndex
+from pf_manager.portfolio.snapshots import PositionSnapshotManager
 from pf_manager.utilfns.log import setup_log
 
 
@@ -22,16 +27,30 @@ class PortfolioManager():
     def positions(self,
                   group_keys: list = [],
                   blotter_df: pd.DataFrame = None) -> pd.DataFrame:
-        """ Return live positions for a particular user, grouped by ticker name """
+        """ 
+        Return live positions for a particular user, grouped by ticker name.
+        Aggregation is done in the database unless a blotter_df is supplied.
+        """
+        group_keys = ["name"] if not group_keys else group_keys
         if not isinstance(blotter_df, pd.DataFrame):
-            data = self._extract_blotter()
-        else:
-            data = blotter_df
+            # Like groupby below, drop groups with a missing key and sort by the keys
+            data = self._extract_trades(group_keys).dropna(subset=group_keys)
+            if data.empty: return data
+            return data.set_index(group_keys)["qty"].sort_index()
 
+        data = blotter_df
         if data.empty: return data
-        group_keys = ["name"] if not group_keys else group_keys
         return data.groupby(group_keys)["qty"].apply(lambda x: x.sum())
 
+    def snapshot_positions(self,
+                           dt: datetime.date = None,
+                           group_keys: list = []) -> pd.DataFrame:
+        """ Same as positions, but read as of dt from the pre-aggregated position_snapshots table """
+        data = PositionSnapshotManager().positions(dt, portfolio=self.portfolio)
+        if data.empty: return data
+        group_keys = ["name"] if not group_keys else group_keys
+        return data.groupby(group_keys)["qty"].sum()
+
     def calc_dividends(self,
                        force_calc: bool = False,
                        to_db: bool = False) -> pd.DataFrame:
@@ -40,56 +59,70 @@ class PortfolioManager():
         force_calc:  recalculate dividends whether it has been calculated previously or not
         to_db: upload results to db
         """
-        results = pd.DataFrame()
-        blotter = self._extract_blotter()
-        for ticker in blotter["name"].unique():
-            logging.info(f"Computing dividends for {ticker}")
-            entries = blotter[blotter["name"] == ticker]
-            sdt = entries["date"].min()
-            edt = entries["date"].max()
-
-            # Market Dividends
+        keys = ["strategy", "portfolio", "book", "name"]
+        trades = self._extract_trades(keys + ["date"], typed=True)
+        if trades.empty: return pd.DataFrame()
+
+        # Market and pre-computed dividends are restricted to each ticker's blotter date range
+        names = list(trades["name"].unique())
+        ranges = trades.groupby("name",
+                                observed=True)["date"].agg(["min", "max"])
+        sdt, edt = trades["date"].min(), trades["date"].max()
+        with sqlalchemy_engine_session() as session:
+            logging.info(f"Getting market dividends for {len(names)} tickers")
+            query_obj, Entity = self.market_dividends_dao.mget_by_dates_custom(
+                session, sdt, edt)
+            market_dividends = query_to_df(
+                query_obj.filter(Entity.name.in_(names)), typed=True)
+            if market_dividends.empty: return pd.DataFrame()
+
+            query_obj, Entity = self.dividends_dao.mget_by_dates_custom(
+                session, sdt, edt)
+            dividends = query_to_df(
+                query_obj.filter(Entity.name.in_(names)), typed=True)
+        market_dividends = self._within_ranges(market_dividends, ranges)
+
+        if not dividends.empty and not force_calc:
+            dividends = self._within_ranges(dividends, ranges)
+            computed = set(zip(dividends["name"], dividends["date"]))
+            market_dividends = market_dividends[[
+                x not in computed for x in zip(market_dividends["name"],
+                                               market_dividends["ex_date"])
+            ]]
+        if market_dividends.empty:
+            logging.info("No new dividends to be computed")
+            return pd.DataFrame()
+        logging.info(f"Computing {len(market_dividends)} dividends")
+
+        # Every book that has traded the name receives the dividend, based on
+        # its position strictly before the ex-date
+        index = PositionIndex(trades, keys)
+        events = market_dividends.assign(
+            date=market_dividends["ex_date"],
+            dps=market_dividends["dividend_amount"] *
+            (1 - market_dividends["witholding_tax"]))[["name", "date", "dps"]]
+        results = []
+        for name, grp in events.groupby("name", sort=False, observed=True):
+            for key in index.keys_for(name):
+                qty = index.asof_many(key,
+                                      grp["date"],
+                                      inclusive=False,
+                                      fill=np.nan)
+                results.append(grp.assign(qty=qty, **dict(zip(keys, key))))
+        if not results: return pd.DataFrame()
+        results = pd.concat(results).dropna(subset=["qty"])
+        if results.empty: return pd.DataFrame()
+
+        results["qty"] = results["qty"].astype(trades["qty"].dtype)
+        results = results.assign(amount=lambda x: x.qty * x.dps)[
+            keys + ["qty", "date", "amount", "dps"]].sort_values(
+                ["name", "date"] + keys).reset_index(drop=True)
+
+        if to_db:
+            logging.info("Committing computed dividends to database")
             with sqlalchemy_engine_session() as session:
-                query_obj, Entity = self.market_dividends_dao.mget_by_dates_custom(
-                    session, sdt, edt)
-                market_dividends = entity_to_df(
-                    query_obj.filter(Entity.name == ticker).all())
-                if market_dividends.empty: continue
-
-                # Pre-computed dividends
-                query_obj, Entity = self.dividends_dao.mget_by_dates_custom(
-                    session, sdt, edt)
-                dividends = entity_to_df(
-                    query_obj.filter(Entity.name == ticker).all())
-
-            if not dividends.empty and not force_calc:
-                dates_to_be_computed = set(market_dividends["ex_date"]) - set(
-                    dividends["date"])
-                if len(dates_to_be_computed) > 0:
-                    logging.info(f"{ticker} has new dividends to be computed")
-                else:
-                    continue
-            else:
-                dates_to_be_computed = set(market_dividends["ex_date"])
-
-            market_dividends = market_dividends.set_index(
-                "ex_date").loc[dates_to_be_computed].reset_index()
-
-            for _, dividend in market_dividends.iterrows():
-                logging.info(
-                    f"Computing dividends for {ticker}-{dividend.get('ex_date')}"
-                )
-                d = self._compute_single_dividend(dividend, entries)
-                results = pd.concat([results, d])
-
-            if to_db:
-                logging.info("Committing computed dividends to database")
-                with sqlalchemy_engine_session() as session:
-                    Entity = self.dividends_dao.Entity
-                    self.dividends_dao.add_all(session, [
-                        Entity(**x) for x in results.to_dict(orient="records")
-                    ])
-                    session.commit()
+                self.dividends_dao.bulk_insert(session, results)
+                session.commit()
         return results
 
     def _compute_capital_gains_pl(self):
@@ -110,27 +143,69 @@ class PortfolioManager():
             query_obj = query_obj if all_flag else query_obj.filter(
                 Entity.portfolio == self.portfolio)
 
-            return entity_to_df(
-                query_obj.filter(Entity.execution_status == "y").all())
+            return query_to_df(
+                query_obj.filter(Entity.execution_status == "y"))
+
+    def _extract_trades(self,
+                        group_keys: list,
+                        all_flag=False,
+                        typed=False) -> pd.DataFrame:
+        """ 
+        Executed quantity summed by group_keys in the database, all_flag to include all portfolios.
+        typed to return low cardinality string columns as categoricals.
+        """
+        logging.info(f"Getting {self.portfolio} trades by {group_keys} from db")
+        where = [("execution_status", "y")]
+        if not all_flag:
+            where.append(("portfolio", self.portfolio))
+        cols = {x: None for x in group_keys}
+        cols["qty"] = "sum"
+        data = orm_blotter.DAO.get(by=group_keys,
+                                   where=where,
+                                   cols=cols,
+                                   typed=typed)
+        if not data.empty:
+            # mysql returns SUM over integers as DECIMAL
+            data["qty"] = data["qty"].astype("int64")
+        return data
 
     def _extract_market_dividends(self) -> pd.DataFrame:
         with sqlalchemy_engine_session() as session:
             logging.info(f"Getting market dividends from db")
-            return entity_to_df(self.market_dividends_dao.mget_all(session))
-
-    def _compute_single_dividend(self, market_dividend: dict,
-                                 blotter: pd.DataFrame) -> pd.DataFrame:
-        """ Calculate actual dividends received based on dividend per share and blotter positions """
+            return query_to_df(
+                self.market_dividends_dao.mget_all_custom(session)[0])
+
+    @staticmethod
+    def _within_ranges(df: pd.DataFrame, ranges: pd.DataFrame) -> pd.DataFrame:
+        """ Keep rows whose date falls within the [min, max] date range of its name """
+        bounds = ranges.reindex(df["name"])
+        mask = (df["date"].values >= bounds["min"].values) & (
+            df["date"].values <= bounds["max"].values)
+        return df[mask]
+
+    def position_index(self, all_flag=False) -> PositionIndex:
+        """ Point-in-time position index over the executed blotter """
+        return PositionIndex(
+            self._extract_trades(PositionIndex.KEYS + ["date"],
+                                 all_flag=all_flag,
+                                 typed=True))
+
+    def _compute_single_dividend(self,
+                                 market_dividend: dict,
+                                 blotter: pd.DataFrame,
+                                 index: PositionIndex = None) -> pd.DataFrame:
+        """ 
+        Calculate actual dividends received based on dividend per share and blotter positions.
+        Pass a prebuilt index when computing many dividends, to avoid re-scanning the blotter.
+        """
         name = market_dividend.get("name")
         ex_date = market_dividend.get("ex_date")
         dps = market_dividend.get("dividend_amount") * (
             1 - market_dividend.get("witholding_tax"))
-        wkdf = blotter[(blotter["name"] == name) & (blotter["date"] < ex_date)]
-        return (self.positions(["strategy", "portfolio", "book", "name"],
-                               wkdf)).reset_index().assign(
-                                   date=ex_date,
-                                   amount=lambda x: x.qty * dps,
-                                   dps=dps)
+        if index is None:
+            index = PositionIndex(blotter)
+        return index.positions(ex_date, inclusive=False, name=name).assign(
+            date=ex_date, amount=lambda x: x.qty * dps, dps=dps)
 
 
 if __name__ == "__main__":
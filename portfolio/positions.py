@@ -0,0 +1,83 @@
+import datetime
+import numpy as np
+import pandas as pd
+
+
+class PositionIndex:
+    """
+    Point-in-time positions built once from a blotter. For every (strategy, portfolio, book, name)
+    the sorted trade dates and cumulative quantities are kept in NumPy arrays, so the position as
+    of any date is a binary search rather than a scan of the blotter.
+    inclusive: include trades done on the as-of date itself (end of day position),
+               dividends use inclusive=False since only trades before the ex-date count
+    """
+    KEYS = ["strategy", "portfolio", "book", "name"]
+
+    def __init__(self, blotter: pd.DataFrame, keys: list = None):
+        self.keys = keys or self.KEYS
+        self._dates = {}  # key -> datetime64[D] array of trade dates
+        self._qty = {}  # key -> cumulative qty after each trade date
+        self._by_name = {}  # name -> keys
+        if blotter is None or blotter.empty:
+            return
+
+        trades = blotter.groupby(self.keys + ["date"],
+                                 observed=True)["qty"].sum().reset_index()
+        trades["date"] = pd.to_datetime(
+            trades["date"]).values.astype("datetime64[D]")
+        trades = trades.sort_values(self.keys + ["date"])
+
+        name_pos = self.keys.index("name")
+        for key, grp in trades.groupby(self.keys, observed=True, sort=False):
+            self._dates[key] = grp["date"].values
+            self._qty[key] = grp["qty"].values.cumsum()
+            self._by_name.setdefault(key[name_pos], []).append(key)
+
+    def __len__(self):
+        return len(self._dates)
+
+    def keys_for(self, name: str = None) -> list:
+        """ All keys, or the keys that have traded a particular name """
+        if name is None:
+            return list(self._dates)
+        return list(self._by_name.get(name, []))
+
+    def asof(self,
+             key: tuple,
+             dt: datetime.date,
+             inclusive: bool = True,
+             fill=0):
+        """ Position of a single key as of dt, fill if the key has not traded by then """
+        return self.asof_many(key, [dt], inclusive=inclusive, fill=fill)[0]
+
+    def asof_many(self,
+                  key: tuple,
+                  dts: list,
+                  inclusive: bool = True,
+                  fill=0) -> np.ndarray:
+        """ Positions of a single key as of each date in dts """
+        dts = pd.to_datetime(pd.Series(dts)).values.astype("datetime64[D]")
+        dates = self._dates.get(key)
+        if dates is None:
+            return np.full(len(dts), fill)
+
+        idx = np.searchsorted(dates, dts,
+                              side="right" if inclusive else "left") - 1
+        return np.where(idx >= 0, self._qty[key][np.maximum(idx, 0)], fill)
+
+    def positions(self,
+                  dt: datetime.date,
+                  inclusive: bool = True,
+                  name: str = None) -> pd.DataFrame:
+        """
+        Positions of every key (optionally filtered by name) as of dt.
+        Keys that have not traded by dt are excluded, closed positions are returned with qty 0.
+        """
+        dt = np.datetime64(pd.Timestamp(dt).date(), "D")
+        side = "right" if inclusive else "left"
+        rows = []
+        for key in self.keys_for(name):
+            i = np.searchsorted(self._dates[key], dt, side=side) - 1
+            if i >= 0:
+                rows.append(key + (self._qty[key][i], ))
+        return pd.DataFrame(rows, columns=self.keys + ["qty"])
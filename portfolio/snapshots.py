@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+PositionSnapshotManager maintains the position_snapshots table, a materialized view of end of day
+positions derived from the executed blotter. New blotter rows are picked up incrementally using the
+highest blotter id already reflected in the table as a watermark.
+Note that edits to existing blotter rows (e.g. execution_status changes) and deletions of blotter
+rows (e.g. by a corrected re-dump of a date) are not picked up by the watermark, run a rebuild after
+such edits or deletions.
+"""
+
+import argparse
+import datetime
+import logging
+import pandas as pd
+
+from pf_manager.db import sqlalchemy_engine_session, dao
+from pf_manager.db.utils import query_to_df
+from pf_manager.utilfns.log import setup_log
+
+
+class PositionSnapshotManager():
+    def __init__(self):
+        self.blotter_dao = dao.get_Blotter_dao()
+        self.snapshot_dao = dao.get_PositionSnapshots_dao()
+        self.keys = self.snapshot_dao.KEYS
+
+    def refresh(self) -> int:
+        """ Apply blotter rows added since the last refresh, returns the number of snapshot rows written """
+        with sqlalchemy_engine_session() as session:
+            watermark = self.snapshot_dao.mget_watermark(session)
+            query_obj, Blotter = self.blotter_dao.mget_all_custom(session)
+            new = query_to_df(query_obj.filter(Blotter.id > watermark))
+            if new.empty:
+                logging.info("Position snapshots are up to date")
+                return 0
+
+            max_id = int(new["id"].max())
+            new = new[new["execution_status"] == "y"]
+            logging.info(
+                f"Applying {len(new)} blotter rows above id {watermark}")
+
+            # Each affected key is recomputed from its earliest new trade date onwards,
+            # which also handles back-dated trades
+            n = 0
+            starts = new.groupby(self.keys)["date"].min()
+            for key, sdt in starts.items():
+                n += self._refresh_key(session, dict(zip(self.keys, key)),
+                                       sdt, max_id)
+            # Also when no snapshot changed, so these blotter rows are not loaded again
+            self.snapshot_dao.upsert_watermark(session, max_id)
+            session.commit()
+        return n
+
+    def rebuild(self) -> int:
+        """ Recompute the entire table from the executed blotter """
+        with sqlalchemy_engine_session() as session:
+            query_obj, Blotter = self.blotter_dao.mget_all_custom(session)
+            blotter = query_to_df(query_obj)
+            self.snapshot_dao.delete_all(session)
+            if blotter.empty:
+                session.commit()
+                return 0
+
+            max_id = int(blotter["id"].max())
+            rows = self._snapshot_rows(
+                blotter[blotter["execution_status"] == "y"], max_id)
+            self._add_rows(session, rows)
+            self.snapshot_dao.upsert_watermark(session, max_id)
+            session.commit()
+        logging.info(f"Rebuilt {len(rows)} position snapshots")
+        return len(rows)
+
+    def positions(self,
+                  dt: datetime.date = None,
+                  portfolio: str = None) -> pd.DataFrame:
+        """ Positions per (strategy, portfolio, book, name) as of end of day dt, defaults to today """
+        dt = dt or datetime.date.today()
+        with sqlalchemy_engine_session() as session:
+            query_obj, Entity = self.snapshot_dao.mget_latest_custom(
+                session, dt)
+            if portfolio:
+                query_obj = query_obj.filter(Entity.portfolio == portfolio)
+            res = query_to_df(query_obj)
+        if res.empty:
+            return pd.DataFrame(columns=self.keys + ["date", "qty"])
+        return res[self.keys + ["date", "qty"]]
+
+    def _refresh_key(self, session, key: dict, sdt: datetime.date,
+                     max_id: int) -> int:
+        Entity = self.snapshot_dao.Entity
+        key_filters = [getattr(Entity, k) == v for k, v in key.items()]
+
+        # Position carried into sdt
+        prior = session.query(Entity.qty).filter(
+            *key_filters, Entity.date < sdt).order_by(
+                Entity.date.desc()).first()
+        base = prior[0] if prior else 0
+
+        session.query(Entity).filter(*key_filters,
+                                     Entity.date >= sdt).delete(
+                                         synchronize_session=False)
+
+        query_obj, Blotter = self.blotter_dao.mget_all_custom(session)
+        trades = query_to_df(
+            query_obj.filter(*[getattr(Blotter, k) == v
+                               for k, v in key.items()],
+                             Blotter.date >= sdt, Blotter.id <= max_id,
+                             Blotter.execution_status == "y"))
+        rows = self._snapshot_rows(trades, max_id, base=base)
+        self._add_rows(session, rows)
+        return len(rows)
+
+    def _snapshot_rows(self,
+                       trades: pd.DataFrame,
+                       max_id: int,
+                       base: int = 0) -> pd.DataFrame:
+        """ End of day cumulative positions on each trade date, offset by the carried in base position """
+        if trades.empty:
+            return pd.DataFrame()
+        rows = trades.groupby(self.keys + ["date"])["qty"].sum().reset_index()
+        rows = rows.sort_values(self.keys + ["date"])
+        rows["qty"] = rows.groupby(self.keys)["qty"].cumsum() + base
+        rows["blotter_id"] = max_id
+        return rows
+
+    def _add_rows(self, session, rows: pd.DataFrame) -> None:
+        if rows.empty:
+            return
+        Entity = self.snapshot_dao.Entity
+        self.snapshot_dao.add_all(session, [
+            Entity(**x) for x in rows.astype(object).to_dict(orient="records")
+        ])
+
+
+if __name__ == "__main__":
+    setup_log()
+    parser = argparse.ArgumentParser(description="Maintain position snapshots")
+    parser.add_argument("command", choices=["refresh", "rebuild"])
+    args = parser.parse_args()
+
+    psm = PositionSnapshotManager()
+    if args.command == "rebuild":
+        psm.rebuild()
+    else:
+        psm.refresh()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Compares the rows/sec of BaseDao.add_all with ORM objects against BaseDao.bulk_insert.
+Runs against a temporary sqlite database unless a url is given, e.g. a scratch mysql schema.
+Usage: ./scripts/bench_bulk_insert.py [--url URL] [--rows N]
+"""
+
+import argparse
+import datetime
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+from pf_manager.db import dao, entity, register_engine, sqlalchemy_engine_session
+
+
+def make_dividends(n: int) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        "date": pd.Timestamp(datetime.date(2021, 3, 5)),
+        "name": rng.choice([f"NAME{i}" for i in range(500)], n),
+        "strategy": "dividend",
+        "portfolio": rng.choice(["SG", "US"], n),
+        "book": "core",
+        "qty": rng.integers(100, 10000, n),
+        "dps": rng.random(n).round(4),
+        "amount": rng.random(n).round(2) * 1000,
+    })
+
+
+def bench(rows: int) -> None:
+    dividends_dao = dao.get_Dividends_dao()
+    Entity = dividends_dao.Entity
+    df = make_dividends(rows)
+
+    def orm_add_all(session):
+        records = df.assign(date=df["date"].dt.date).to_dict(orient="records")
+        dividends_dao.add_all(session, [Entity(**x) for x in records])
+
+    def bulk_insert(session):
+        dividends_dao.bulk_insert(session, df)
+
+    writes = [("add_all", orm_add_all), ("bulk_insert", bulk_insert)]
+    with sqlalchemy_engine_session() as session:
+        if session.bind.dialect.name == "mysql":
+            writes.append(("load_infile", lambda session: dividends_dao.
+                           bulk_insert(session, df, infile=True)))
+
+    for label, write in writes:
+        with sqlalchemy_engine_session() as session:
+            dividends_dao.delete_all(session)
+            session.commit()
+            t0 = time.monotonic()
+            write(session)
+            session.commit()
+            elapsed = time.monotonic() - t0
+        print(f"{label:<12} {rows} rows in {elapsed:6.2f}s, "
+              f"{rows / elapsed:10.0f} rows/sec")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk insert benchmark")
+    parser.add_argument("--url", default=None)
+    parser.add_argument("--rows", type=int, default=100000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = register_engine(
+            args.url or f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        entity.Dividends.__table__.create(engine, checkfirst=True)
+        bench(args.rows)
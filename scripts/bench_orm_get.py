@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the per call overhead of BaseDAOModel.get, with and without baked queries.
+Runs against an in-memory sqlite database so that query construction and compilation dominate.
+Usage: ./scripts/bench_orm_get.py [n_calls]
+"""
+
+import sys
+import timeit
+
+from pf_manager.db import orm
+from pf_manager.db.orm.reference_data import DAO, Entity
+
+QUERIES = {
+    "select by country":
+    lambda i: DAO.get(where=[("main_country", f"country_{i % 10}"),
+                             ("active", True), ("asset_class", "equity")],
+                      cols=["yahoo_ticker"]),
+    "in filter":
+    lambda i: DAO.get(where=[("name", [f"name_{i % 100}", f"name_{i % 7}"],
+                              "in")]),
+    "group by":
+    lambda i: DAO.get(by=["main_country"],
+                      where=[("active", bool(i % 2))],
+                      cols={
+                          "main_country": None,
+                          "n": ("max", "yahoo_ticker")
+                      }),
+}
+
+
+def setup(n_rows: int = 100) -> None:
+    orm.init(url="sqlite://")
+    Entity.metadata.create_all(orm._engine)
+    with orm._session() as ss:
+        ss.add_all([
+            Entity(name=f"name_{i}",
+                   yahoo_ticker=f"T{i}.SI",
+                   main_country=f"country_{i % 10}",
+                   asset_class="equity",
+                   active=bool(i % 2)) for i in range(n_rows)
+        ])
+
+
+def bench(n_calls: int) -> None:
+    for label, query in QUERIES.items():
+        timings = {}
+        for baked in [False, True]:
+            DAO.use_baked_queries = baked
+            query(0)  # Warm up, baked queries are built on the first call of each shape
+            counter = iter(range(n_calls))
+            timings[baked] = timeit.timeit(lambda: query(next(counter)),
+                                           number=n_calls) / n_calls * 1e6
+        print(f"{label:<20} plain {timings[False]:8.1f} us/call   "
+              f"baked {timings[True]:8.1f} us/call   "
+              f"speedup {timings[False] / timings[True]:.2f}x")
+
+
+if __name__ == "__main__":
+    setup()
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
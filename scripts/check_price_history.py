@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Regression check of PriceHistoryStore.append, see marketdata.history.
+A source that repeats a date, e.g. the live bar of an unfinished session, must have its last row
+for that date stored, and refreshing with overwrite_from must replace the stored partial bar.
+Usage: ./scripts/check_price_history.py
+"""
+
+import datetime
+import tempfile
+
+import pandas as pd
+
+from pf_manager.marketdata.history import PriceHistoryStore
+
+D1, D2, D3 = [datetime.date(2024, 1, x) for x in (2, 3, 4)]
+
+
+def check(path: str) -> None:
+    store = PriceHistoryStore(path)
+    failures = []
+
+    def expect(label, arr, expected):
+        got = [(str(x["date"]), float(x["open"])) for x in arr]
+        ok = got == expected
+        print(f"{label:<28} {got} {'ok' if ok else f'expected {expected}'}")
+        if not ok:
+            failures.append(label)
+
+    store.append(
+        "A", pd.DataFrame({
+            "date": [D1, D2, D2],
+            "open": [1., 9., 2.]
+        }))
+    expect("repeated date", store.load("A"), [("2024-01-02", 1.),
+                                              ("2024-01-03", 2.)])
+    store.append("A",
+                 pd.DataFrame({
+                     "date": [D2, D3, D3],
+                     "open": [3., 8., 4.]
+                 }),
+                 overwrite_from=D2)
+    expect("overwrite partial bar", store.load("A"), [("2024-01-02", 1.),
+                                                      ("2024-01-03", 3.),
+                                                      ("2024-01-04", 4.)])
+    if failures:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp:
+        check(tmp)
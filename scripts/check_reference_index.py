@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Regression check of the in-memory reference data index, see db.orm.reference_data.DAO.index.
+The index is read while a write transaction is still open, and must show the write once it commits.
+Runs against a temporary sqlite database unless a url is given.
+Usage: ./scripts/check_reference_index.py [--url URL]
+"""
+
+import argparse
+import concurrent.futures
+import os
+import tempfile
+
+from pf_manager.db import orm
+from pf_manager.db.orm.reference_data import DAO, Entity
+
+
+def setup(url: str) -> None:
+    orm.init(url=url)
+    Entity.metadata.create_all(orm._engine)
+    with orm._session() as ss:
+        ss.add(Entity(name="OLD", yahoo_ticker="OLD.SI", active=True))
+
+
+def _in_transaction(write) -> list:
+    """
+    Runs write in a transaction, returns the tickers of the index read by another thread before it
+    commits. The other thread has its own session, so it reads the rows from before the write
+    """
+    with orm._session() as ss:
+        token = orm._ss.set(ss)
+        try:
+            write()
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+                return pool.submit(
+                    lambda: DAO.index().tickers("yahoo")).result()
+        finally:
+            orm._ss.reset(token)
+
+
+def check() -> None:
+    failures = []
+
+    def expect(label, tickers, expected):
+        ok = tickers == expected
+        print(f"{label:<28} {tickers} {'ok' if ok else f'expected {expected}'}")
+        if not ok:
+            failures.append(label)
+
+    expect("initial", DAO.index().tickers("yahoo"), ["OLD.SI"])
+    expect(
+        "before insert commits",
+        _in_transaction(lambda: DAO.insert(
+            Entity(name="NEW", yahoo_ticker="NEW.SI", active=True))),
+        ["OLD.SI"])
+    expect("after insert commits", DAO.index().tickers("yahoo"),
+           ["OLD.SI", "NEW.SI"])
+    expect("before delete commits",
+           _in_transaction(lambda: DAO.del_by_ticker(ticker="OLD.SI")),
+           ["OLD.SI", "NEW.SI"])
+    expect("after delete commits", DAO.index().tickers("yahoo"), ["NEW.SI"])
+    if failures:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Reference data index regression check")
+    parser.add_argument("--url", default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        setup(args.url or f"sqlite:///{os.path.join(tmp, 'index.db')}")
+        check()
@@ -1,11 +1,18 @@
 #!/usr/bin/env python3
+"""
+Create and seed the tables in cfg["tables"] from the csv templates.
+Tables are created in a single DDL pass, and seeded concurrently on separate pooled connections.
+Usage: ./scripts/seed_tables.py [--workers N]
+"""
 
+import argparse
+import concurrent.futures
 import logging
 import os
-import pandas as pd
+import time
 
 from pf_manager.db import entity, dao, sqlalchemy_engine_session
-from pf_manager.db.table import recreate_table
+from pf_manager.db.table import recreate_tables
 from pf_manager.db.utils import dao_entity_generators
 from pf_manager.utilfns.cfg import read_cfg
 from pf_manager.utilfns.log import setup_log
@@ -15,6 +22,10 @@ cfg = read_cfg()
 BASE_DIR = os.path.join(os.path.dirname(__file__), "..")
 
 
+def _entity_name(table: str) -> str:
+    return "".join([x.capitalize() for x in table.split("_")])
+
+
 def generate_orm() -> None:
     for table in cfg.get("tables"):
         path = os.path.join(BASE_DIR, "templates",
@@ -24,45 +35,53 @@ def generate_orm() -> None:
 
 def create():
     """ Create initial tables """
-    for table in cfg.get("tables"):
-        logging.info(f"Creating {table} in db")
-        entity_name = "".join([x.capitalize() for x in table.split("_")])
-        Entity = getattr(entity, entity_name)
-        recreate_table(Entity)  # Delete and create database table
+    tables = cfg.get("tables")
+    logging.info(f"Creating {', '.join(tables)} in db")
+    # Delete and create database tables
+    recreate_tables([getattr(entity, _entity_name(x)) for x in tables])
 
 
-def seed():
-    """ Seed initial tables """
-    for table in cfg.get("tables"):
-        # for table in cfg.get("seeded_tables"):
-        logging.info(f"Seeding {table} with data")
-        path = os.path.join(BASE_DIR, "templates",
-                            "template_" + table + ".csv")
-        entity_name = "".join([x.capitalize() for x in table.split("_")])
-        Entity = getattr(entity, entity_name)
-        dao_obj = getattr(dao, f'get_{entity_name}_dao')()
-        data = pd.read_csv(path)
-
-        # Convert dates to python understandable dates
-        for col in ["date", "ex_date"]:
-            if col in data:
-                data[col] = pd.to_datetime(data[col]).apply(lambda x: x.date())
-        data = data.where(pd.notnull(data), None).to_dict(orient="records")
-        entities = [Entity(**x) for x in data]
-
-        try:
-            with sqlalchemy_engine_session() as session:
-                logging.info("Attempting to dump entities into db")
-                dao_obj.add_all(session, entities)
-                session.commit()
-                logging.info(
-                    f"Successfully dumped {len(entities)} entities into db")
-        except Exception as e:
-            logging.error(f'Dumping failed. Logs: {e}')
-            raise e
+def seed_table(table: str) -> tuple:
+    """ Seed a single table in its own session, returns (rows, seconds) """
+    logging.info(f"Seeding {table} with data")
+    path = os.path.join(BASE_DIR, "templates", "template_" + table + ".csv")
+    dao_obj = getattr(dao, f'get_{_entity_name(table)}_dao')()
+
+    t0 = time.monotonic()
+    try:
+        with sqlalchemy_engine_session() as session:
+            logging.info(f"Attempting to dump {table} rows into db")
+            n = dao_obj.bulk_insert_csv(session, path)
+            session.commit()
+    except Exception as e:
+        logging.error(f'Dumping {table} failed. Logs: {e}')
+        raise e
+    elapsed = time.monotonic() - t0
+    logging.info(f"Successfully dumped {n} {table} rows into db")
+    return n, elapsed
+
+
+def seed(n_workers: int = 4) -> dict:
+    """ Seed initial tables concurrently, returns table -> (rows, seconds) """
+    tables = cfg.get("tables")
+    # tables = cfg.get("seeded_tables")
+    t0 = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=n_workers) as executor:
+        timings = dict(zip(tables, executor.map(seed_table, tables)))
+
+    for table, (n, elapsed) in timings.items():
+        logging.info(f"{table:<20} {n:>10} rows {elapsed:8.2f}s")
+    logging.info(
+        f"Seeded {len(tables)} tables in {time.monotonic() - t0:.2f}s")
+    return timings
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create and seed tables")
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
     # generate_orm()
     create()
-    seed()
\ No newline at end of file
+    seed(n_workers=args.workers)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Stress test of concurrent BaseDAOModel.get calls from a thread pool, while other threads hold open
+transactions. Every result is checked against the same query run serially.
+Runs against a temporary sqlite database unless a url is given.
+Usage: ./scripts/stress_orm_sessions.py [--url URL] [--workers N] [--calls N]
+"""
+
+import argparse
+import concurrent.futures
+import os
+import tempfile
+import threading
+import time
+
+from pf_manager.db import orm
+from pf_manager.db.orm.reference_data import DAO, Entity
+
+QUERIES = [
+    dict(where=[("main_country", "country_1")], cols=["name", "yahoo_ticker"]),
+    dict(where=[("name", ["name_1", "name_2", "name_3"], "in")]),
+    dict(by=["main_country"], cols={
+        "main_country": None,
+        "n": ("max", "name")
+    }),
+    dict(where=[("active", True)], cols=["yahoo_ticker"], df_flag=False),
+]
+
+
+def setup(url: str, n_rows: int = 1000) -> None:
+    orm.init(url=url)
+    Entity.metadata.create_all(orm._engine)
+    with orm._session() as ss:
+        ss.add_all([
+            Entity(name=f"name_{i}",
+                   yahoo_ticker=f"T{i}.SI",
+                   main_country=f"country_{i % 10}",
+                   active=bool(i % 2)) for i in range(n_rows)
+        ])
+
+
+def _result(query: dict):
+    res = DAO.get(**query)
+    if query.get("df_flag", True):
+        return res.sort_values(list(res.columns)).values.tolist()
+    return sorted(x.yahoo_ticker for x in res)
+
+
+def _hold_transaction(stop: threading.Event, sessions: set) -> None:
+    """ Keeps a transaction open so that any session leaking into other threads would show up """
+    def work():
+        with orm._session() as ss:
+            sessions.add(id(ss))
+            while not stop.is_set():
+                DAO.get(where=[("name", "name_0")])
+                time.sleep(0.001)
+
+    orm.transaction(work)
+
+
+def stress(workers: int, calls: int) -> None:
+    expected = [_result(q) for q in QUERIES]
+
+    stop = threading.Event()
+    tx_sessions = set()
+    holders = [
+        threading.Thread(target=_hold_transaction, args=(stop, tx_sessions))
+        for _ in range(2)
+    ]
+    for t in holders:
+        t.start()
+
+    def check(i):
+        assert orm._ss.get() is None, "transaction session leaked into a worker"
+        return _result(QUERIES[i % len(QUERIES)]) == expected[i % len(QUERIES)]
+
+    t0 = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        ok = list(pool.map(check, range(calls)))
+    elapsed = time.monotonic() - t0
+
+    stop.set()
+    for t in holders:
+        t.join()
+
+    print(f"{calls} calls on {workers} threads in {elapsed:.2f}s, "
+          f"{sum(ok)} correct, {len(ok) - sum(ok)} wrong, "
+          f"{len(tx_sessions)} transaction sessions")
+    if not all(ok):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Concurrent DAO.get stress test")
+    parser.add_argument("--url", default=None)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--calls", type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        setup(args.url or f"sqlite:///{os.path.join(tmp, 'stress.db')}")
+        stress(args.workers, args.calls)
@@ -2,11 +2,17 @@ from abc import ABC, abstractmethod
 import concurrent.futures
 import datetime
 from functools import partial
+import hashlib
+import itertools
 import logging
+import os
 import pandas as pd
+from pandas.api.types import is_bool_dtype, is_numeric_dtype, is_object_dtype
 
-from pf_manager.db import sqlalchemy_engine_session
-from pf_manager.db.utils import dao_entity_generators
+from pf_manager.db import entity, get_engine, sqlalchemy_engine_session
+from pf_manager.db.dao import get_DumpManifest_dao
+from pf_manager.db.table import recreate_table
+from pf_manager.db.utils import dao_entity_generators, read_csv_chunks
 
 
 class Dumper(ABC):
@@ -20,42 +26,49 @@ class Dumper(ABC):
     dump_single: Dump single day data to db, must specify a date
     dump_all: Delete entire table before dumping data to db (Use with care)
     dump_parallel: Allow multiprocessing when reading in data, before sequentially dumping data to db
+    dump_pipelined: Load on a persistent process pool and write each date as soon as it is loaded
+    read_csv_chunks: Stream a csv of the Entity as typed chunks, see _load_single_chunks
     create_table: Delete and recreate table based on the Entity (Use with care)
     infer_dtypes: dao and Entity generator, which infers schema using pandas dtype
+    Write modes:
+    replace: delete all rows of the date and insert the new ones
+    merge: only write the difference with the rows of the date, matched on the natural key given
+           by key, which defaults to the KEYS of the dao
+    Change detection:
+    Child classes that implement _get_source_paths have the content hash, row count and mtime of the
+    source of every dumped date recorded in the dump_manifest table. The dump methods then also
+    re-dump dates that are already in the db but whose source has changed since.
     """
-    def __init__(self, dao, Entity, db="coredb"):
+    def __init__(self, dao, Entity, db="coredb", mode="replace", key=None):
+        assert mode in ["replace", "merge"]
+        if mode == "merge" and not (key or getattr(dao, "KEYS", None)):
+            raise ValueError(
+                f"A natural key is required to merge into {Entity.__tablename__}")
         self.dao = dao
         self.Entity = Entity
         self.DB = db
+        self.mode = mode
+        self.key = key
+        self.manifest_dao = get_DumpManifest_dao()
+        self._manifest_created = False
 
     def dump(self, **kwargs) -> None:
-        """ Dump multiple days of data that are not present in the database """
-        dates = self._get_file_dates()
-        assert isinstance(dates, set) or isinstance(dates, dict)
-
-        if isinstance(dates, dict):
-            dts = dates.copy()
-            dates = set(dates.keys())
-            kwargs["dts"] = dts
-        db_dates = self._get_distinct_dates_from_db()
-        dates = dates - db_dates
-
-        logging.info(
-            f'Detected {len(dates)} new files to be dumped into the database')
+        """ Dump multiple days of data that are not present in the database, or whose source changed """
+        dates = self._get_dates_to_dump(kwargs)
 
         # Begin loading and dumping sequentially - this is not done in parallel due to
         # potential issues with locking of the database rows during the writing process
         for dt in dates:
             logging.info(f"Begin loading data for {dt}")
 
-            df = self._load_single_data(dt, **kwargs).fillna(value=0.)
-            if len(df) == 0:
+            fingerprint = self._get_fingerprint(dt, **kwargs)
+            chunks = self._load_chunks(dt, **kwargs)
+            if chunks is None:
                 logging.info(f"No data to be dumped for {dt}")
                 continue
 
-            entity_by_date = self._cvt_df_to_entities(df)
             logging.info(f"Begin dump for {dt}")
-            self._dump_entities(entity_by_date)
+            self._dump_chunks(chunks, fingerprint)
 
     def dump_all(self) -> None:
         """ Use with care, this will wipe the entire table and reload everything """
@@ -63,19 +76,9 @@ class Dumper(ABC):
         self.dump()
 
     def dump_parallel(self, n_workers=4, **kwargs) -> None:
-        """ Dump multiple days of data that are not present in the database """
+        """ Dump multiple days of data that are not present in the database, or whose source changed """
         assert n_workers <= 8  # Don't allow more than 8 processes to be spun up
-        dates = self._get_file_dates()
-        assert isinstance(dates, set) or isinstance(dates, dict)
-        if isinstance(dates, dict):
-            dts = dates.copy()
-            dates = set(dates.keys())
-            kwargs["dts"] = dts
-        db_dates = self._get_distinct_dates_from_db()
-        dates = dates - db_dates
-
-        logging.info(
-            f'Detected {len(dates)} new files to be dumped into the database')
+        dates = self._get_dates_to_dump(kwargs)
 
         # Begin loading in parallel
         gen = self.chunks(dates, n_workers)
@@ -86,47 +89,201 @@ class Dumper(ABC):
             with concurrent.futures.ProcessPoolExecutor(
                     max_workers=n_workers) as executor:
                 results = executor.map(
-                    partial(self._load_single_data, **kwargs), dates)
+                    partial(self._load_with_fingerprint, **kwargs), dates)
 
             # Insertion is still sequential, probably can be in parallel too
-            for df in results:
+            for df, fingerprint in results:
                 if len(df) == 0:
                     continue
                 df.fillna(0., inplace=True)
-                entity_by_date = self._cvt_df_to_entities(df)
                 logging.info(f"Begin dump for {dts_str}")
-                self._dump_entities(entity_by_date)
+                self._dump_df(df, fingerprint)
+
+    def dump_pipelined(self,
+                       n_workers: int = 4,
+                       max_pending: int = None,
+                       **kwargs) -> None:
+        """ 
+        Dump multiple days of data that are not present in the database, or whose source changed.
+        Dates are loaded on a single long-lived process pool, while the calling process writes each
+        loaded date as soon as it is ready, so that loading and writing overlap. Writes stay sequential.
+        max_pending: maximum number of dates loading or waiting to be written, which bounds memory,
+                     defaults to twice n_workers
+        """
+        max_pending = max_pending or 2 * n_workers
+        dates = self._get_dates_to_dump(kwargs)
+
+        load = partial(self._load_with_fingerprint, **kwargs)
+        queue = iter(dates)
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=n_workers) as executor:
+            pending = {}
+            try:
+                while True:
+                    # Keep the pool busy, up to max_pending loaded or loading dates
+                    for dt in queue:
+                        logging.info(f"Begin loading data for {dt}")
+                        pending[executor.submit(load, dt)] = dt
+                        if len(pending) >= max_pending:
+                            break
+                    if not pending:
+                        break
+
+                    done, _ = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        dt = pending.pop(future)
+                        df, fingerprint = future.result()
+                        if len(df) == 0:
+                            logging.info(f"No data to be dumped for {dt}")
+                            continue
+                        df.fillna(0., inplace=True)
+                        logging.info(f"Begin dump for {dt}")
+                        self._dump_df(df, fingerprint)
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
 
     def dump_single(self, dt: datetime.date, **kwargs) -> None:
         """ Dump single day portfolio to the database """
         logging.info(f"Begin loading data for {dt}")
 
-        df = self._load_single_data(dt, **kwargs)
-        if len(df) == 0:
+        fingerprint = self._get_fingerprint(dt, **kwargs)
+        chunks = self._load_chunks(dt, **kwargs)
+        if chunks is None:
             logging.info(f'No data to be dumped for {dt}')
             return
 
-        df.fillna(0., inplace=True)
-        entity_by_date = self._cvt_df_to_entities(df)
         logging.info(f"Begin dump for {dt}")
-        self._dump_entities(entity_by_date)
+        self._dump_chunks(chunks, fingerprint)
 
     def create_table(self) -> None:
         """ Fires a create table SQL based on Entity mapped to the broker file type """
-        from pf_manager.db.table import recreate_table  # An engine object is created in this class, hence this should not be a global import
         try:
             logging.info("Creating table")
-            recreate_table(self.Entity)
+            recreate_table(self.Entity, engine=get_engine(db=self.DB))
+            self._clear_manifest()
             logging.info("Successfully created table")
         except:
             logging.error("Failed to create table")
 
+    def read_csv_chunks(self,
+                        path: str,
+                        chunksize: int = 50000,
+                        date_format: str = None,
+                        **kwargs):
+        """ Typed chunks of a csv of the Entity, see db.utils.read_csv_chunks """
+        return read_csv_chunks(path,
+                               self.Entity,
+                               chunksize=chunksize,
+                               date_format=date_format,
+                               **kwargs)
+
     @staticmethod
     def infer_dtypes(tableName: str,
                      path: str = None,
                      df: pd.DataFrame = None):
         return dao_entity_generators(tableName, path=path, df=df)
 
+    def _get_dates_to_dump(self, kwargs: dict) -> list:
+        """ Dates missing from the db plus dates whose source changed since they were dumped, sets kwargs["dts"] """
+        dates = self._get_file_dates()
+        assert isinstance(dates, set) or isinstance(dates, dict)
+        if isinstance(dates, dict):
+            dts = dates.copy()
+            dates = set(dates.keys())
+            kwargs["dts"] = dts
+        db_dates = self._get_distinct_dates_from_db()
+        new = dates - db_dates
+        changed = self._get_changed_dates(dates & db_dates, **kwargs)
+
+        logging.info(
+            f'Detected {len(new)} new files to be dumped into the database')
+        if changed:
+            logging.info(
+                f'Detected {len(changed)} changed files to be re-dumped into the database'
+            )
+        return sorted(new | changed)
+
+    def _get_changed_dates(self, dates: set, **kwargs) -> set:
+        """ 
+        Dates in the db whose source no longer matches the manifest. Sources with an unchanged mtime
+        are not hashed. Dates dumped before the manifest existed are recorded as they are now.
+        """
+        if not dates or self._get_source_paths(min(dates), **kwargs) is None:
+            return set()
+
+        changed = set()
+        table_name = self.Entity.__tablename__
+        self._create_manifest()
+        with sqlalchemy_engine_session(db=self.DB) as session:
+            manifest = self.manifest_dao.mget_by_table(session, table_name)
+            for dt in sorted(dates):
+                entry = manifest.get(dt)
+                mtime = self._get_source_mtime(dt, **kwargs)
+                if entry is not None and entry.mtime == mtime:
+                    continue
+                fingerprint = self._get_fingerprint(dt, **kwargs)
+                if entry is None:
+                    self.manifest_dao.upsert(session, table_name, dt,
+                                             **fingerprint)
+                elif entry.hash != fingerprint["hash"]:
+                    changed.add(dt)
+                else:
+                    # Touched but identical, skip hashing next time
+                    self.manifest_dao.upsert(session,
+                                             table_name,
+                                             dt,
+                                             mtime=fingerprint["mtime"])
+            session.commit()
+        return changed
+
+    def _get_source_paths(self, dt: datetime.date, **kwargs) -> list:
+        """ Files that the data of dt is loaded from, implement to enable change detection """
+        return None
+
+    def _get_source_mtime(self, dt: datetime.date, **kwargs):
+        paths = self._get_source_paths(dt, **kwargs)
+        # Second precision, which is what a mysql DATETIME holds
+        return datetime.datetime.fromtimestamp(
+            int(max(os.path.getmtime(x) for x in paths)))
+
+    def _get_fingerprint(self, dt: datetime.date, **kwargs) -> dict:
+        """ Content hash and latest mtime of the source of dt, None without _get_source_paths """
+        paths = self._get_source_paths(dt, **kwargs)
+        if paths is None:
+            return None
+        mtime = self._get_source_mtime(dt, **kwargs)
+        sha = hashlib.sha256()
+        for path in sorted(paths):
+            sha.update(os.path.basename(path).encode())
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    sha.update(block)
+        return {"hash": sha.hexdigest(), "mtime": mtime}
+
+    def _load_with_fingerprint(self, dt: datetime.date, **kwargs) -> tuple:
+        """ 
+        (_load_single_data, _get_fingerprint) of dt, so that process pool workers also do the hashing.
+        The source is hashed before it is loaded, a change in between is picked up by the next dump
+        """
+        fingerprint = self._get_fingerprint(dt, **kwargs)
+        return self._load_single_data(dt, **kwargs), fingerprint
+
+    def _create_manifest(self) -> None:
+        if not self._manifest_created:
+            entity.DumpManifest.__table__.create(get_engine(db=self.DB),
+                                                 checkfirst=True)
+            self._manifest_created = True
+
+    def _clear_manifest(self) -> None:
+        with sqlalchemy_engine_session(db=self.DB) as session:
+            self._create_manifest()
+            self.manifest_dao.delete_by_table(session,
+                                              self.Entity.__tablename__)
+            session.commit()
+
     def _get_distinct_dates_from_db(self):
         # create a list of dates that exist in the table from the db
         with sqlalchemy_engine_session(db=self.DB) as session:
@@ -143,23 +300,78 @@ class Dumper(ABC):
         """ A pandas dataframe to be uploaded into the database """
         raise NotImplementedError
 
-    def _cvt_df_to_entities(self, df: pd.DataFrame) -> list:
-        res = []
-        data = df.to_dict(orient="records")
-        [res.append(self.Entity(**x)) for x in data]
-        return res
+    def _load_single_chunks(self, dt: datetime.date, **kwargs):
+        """ 
+        The data of dt as an iterable of DataFrames, which dump and dump_single write chunk by chunk.
+        Defaults to the single frame of _load_single_data, override with read_csv_chunks to stream
+        large files with flat memory
+        """
+        return [self._load_single_data(dt, **kwargs)]
+
+    def _load_chunks(self, dt: datetime.date, **kwargs):
+        """ Non empty chunks of dt with missing values filled, None if there is no data """
+        chunks = (self._fill_missing(x)
+                  for x in self._load_single_chunks(dt, **kwargs) if len(x))
+        first = next(chunks, None)
+        return None if first is None else itertools.chain([first], chunks)
+
+    @staticmethod
+    def _fill_missing(df: pd.DataFrame) -> pd.DataFrame:
+        """ 
+        Fill missing numeric and string values with 0. Typed chunks of read_csv_chunks can't hold 0 in
+        boolean and date columns, their missing values are written as NULL instead
+        """
+        cols = [
+            col for col, dtype in df.dtypes.items()
+            if (is_numeric_dtype(dtype) and not is_bool_dtype(dtype))
+            or is_object_dtype(dtype)
+        ]
+        return df.fillna({col: 0. for col in cols})
+
+    def _dump_df(self, df: pd.DataFrame, fingerprint: dict = None) -> None:
+        self._dump_chunks([df], fingerprint)
 
-    def _dump_entities(self, entities: list) -> None:
+    def _dump_chunks(self, chunks, fingerprint: dict = None) -> None:
+        """ 
+        Write the rows of a single date according to the write mode, without building ORM objects.
+        In replace mode chunks are inserted as they arrive, merge needs all of them at once.
+        fingerprint of the source is recorded in the manifest within the same transaction
+        """
+        if fingerprint is not None:
+            self._create_manifest()
+        chunks = iter(chunks)
+        first = next(chunks)
+        dt = pd.Timestamp(first["date"].iloc[0]).date()
         try:
             with sqlalchemy_engine_session(db=self.DB) as session:
-                logging.info("Attempting to dump entities into db")
-                self.dao.add_by_date(session, entities)
+                logging.info("Attempting to dump rows into db")
+                if self.mode == "merge":
+                    df = pd.concat([first, *chunks], ignore_index=True)
+                    counts = self.dao.merge_by_date(session, df, key=self.key)
+                    row_count = len(df)
+                    logging.info(f"Merging rows into db: {counts}")
+                else:
+                    # Deletes the rows of the date and checks that the chunk holds a single date
+                    row_count = self.dao.bulk_insert_by_date(session, first)
+                    for chunk in chunks:
+                        if (pd.to_datetime(chunk["date"]).dt.date != dt).any():
+                            raise Exception(
+                                "There should only be one file date present in the list of records"
+                            )
+                        row_count += self.dao.bulk_insert(session, chunk)
+                    logging.info(f"Dumping {row_count} rows into db")
+                if fingerprint is not None:
+                    self.manifest_dao.upsert(
+                        session,
+                        self.Entity.__tablename__,
+                        dt,
+                        row_count=row_count,
+                        dumped_at=datetime.datetime.now(),
+                        **fingerprint)
                 session.commit()
-                logging.info(
-                    f"Successfully dumped {len(entities)} entities into db")
+                logging.info("Successfully dumped rows into db")
         except Exception as e:
-            logging.error(
-                f'Dumping failed for {entities[0].filedate}. Logs: {e}')
+            logging.error(f'Dumping failed for {dt}. Logs: {e}')
             raise e
 
     @staticmethod